@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+"""Benchmarks for the processing functions of py_imagelab
+
+Runs the cartoon, face detection and foreground extraction processes on
+synthetic images at several resolutions and reports the timings,
+throughput and peak memory as JSON.  The results can be saved as a
+baseline and later runs compared against it.
+
+Usage::
+
+    python -m py_imagelab.bench --resolutions vga 1080p --repeat 5
+    python -m py_imagelab.bench --save-baseline baseline.json
+    python -m py_imagelab.bench --baseline baseline.json
+"""
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+import numpy as np
+import cv2
+from py_imagelab.profiling import StageTimer
+
+# (height, width) of the benchmark resolutions
+RESOLUTIONS = {
+    "vga": (480, 640),
+    "720p": (720, 1280),
+    "1080p": (1080, 1920),
+    "4k": (2160, 3840),
+}
+DEFAULT_RESOLUTIONS = ["vga", "1080p", "4k"]
+
+
+def synthetic_image(height, width, seed=0):
+    """Create a synthetic test image
+
+    Smooth color gradients with random filled shapes and some noise, so
+    the edge preserving filters and detectors have structure to work on.
+
+    Parameters
+    ----------
+    height : int
+        Image height
+
+    width : int
+        Image width
+
+    seed : int
+        Seed of the random generator
+
+    Returns
+    -------
+    image : np.ndarray
+        (height, width, 3) uint8 BGR image
+    """
+    rng = np.random.default_rng(seed)
+
+    # -----------------------  background gradient  -------------------------
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :]
+    image = np.empty((height, width, 3), np.uint8)
+    image[:, :, 0] = 255 * (0.5 * x + 0.5 * y)
+    image[:, :, 1] = 255 * (1 - x) * y
+    image[:, :, 2] = 255 * x * (1 - y)
+
+    # -------------------------  random shapes  -----------------------------
+    scale = min(height, width)
+    for _ in range(40):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cx, cy = int(rng.integers(0, width)), int(rng.integers(0, height))
+        size = int(rng.integers(scale // 40, scale // 6))
+        if rng.random() < 0.5:
+            cv2.circle(image, (cx, cy), size, color, thickness=-1)
+        else:
+            cv2.rectangle(image, (cx, cy), (cx + size, cy + size), color,
+                thickness=-1)
+
+    # ----------------------------  noise  ----------------------------------
+    noise = rng.normal(0, 6, image.shape).astype(np.int16)
+    image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return image
+
+
+def synthetic_scene(height, width):
+    """Synthetic image with a distinct foreground object
+
+    An ellipse filled with one synthetic image over the background of
+    another, inside the default GrabCut rectangle.
+
+    Returns
+    -------
+    image : np.ndarray
+        (height, width, 3) uint8 BGR image
+
+    truth : np.ndarray
+        (height, width) bool foreground mask
+    """
+    background = synthetic_image(height, width, seed=1)
+    foreground = synthetic_image(height, width, seed=2)[:, ::-1]
+    truth = np.zeros((height, width), np.uint8)
+    cv2.ellipse(truth, (width // 2, height // 2), (width // 5, height // 4),
+        0, 0, 360, 1, thickness=-1)
+    image = np.where(truth[:, :, np.newaxis] == 1, foreground, background)
+    return image, truth.astype(bool)
+
+
+def _case_cartoon():
+    from py_imagelab.cartoon.cartoon import cartoonify_process
+    from py_imagelab.cartoon.cartoon import DEFAULT_CARTOONIFY
+    return lambda im, timer=None: cartoonify_process(im, timer=timer,
+        **DEFAULT_CARTOONIFY)
+
+
+def _case_face_cascade():
+    from py_imagelab.segmentation.face_detection import FaceDetectCascade
+    return FaceDetectCascade().detect_face
+
+
+def _case_face_dlib():
+    from py_imagelab.segmentation.face_detection_dlib import FaceDetectDlib
+    return FaceDetectDlib().detect_face
+
+
+def _case_face_cascade_720():
+    from py_imagelab.segmentation.face_detection import FaceDetectCascade
+    return FaceDetectCascade(max_pixels=1280 * 720).detect_face
+
+
+def _case_face_dlib_720():
+    from py_imagelab.segmentation.face_detection_dlib import FaceDetectDlib
+    return FaceDetectDlib(max_pixels=1280 * 720).detect_face
+
+
+def _case_grabcut():
+    from py_imagelab.segmentation.foreground_extraction import Foreground
+    # new Foreground per call, the mask is sized on the first image
+    return lambda im, timer=None: Foreground().extract_foreground(im,
+        timer=timer)
+
+
+# name of the case -> factory returning process(image, timer=None)
+CASES = {
+    "cartoon": _case_cartoon,
+    "face_cascade": _case_face_cascade,
+    "face_dlib": _case_face_dlib,
+    "face_cascade_720": _case_face_cascade_720,
+    "face_dlib_720": _case_face_dlib_720,
+    "grabcut": _case_grabcut,
+}
+
+
+def time_process(process, image, repeat=3):
+    """Time a process on an image
+
+    Parameters
+    ----------
+    process : func
+        Function called as process(image, timer=None)
+
+    image : np.ndarray
+        The input image
+
+    repeat : int
+        Number of timed calls (after one warm up call)
+
+    Returns
+    -------
+    stats : dict
+        Timing statistics in seconds, the time of each stage of one call
+        and the peak memory in MB of the traced (numpy) allocations
+        during one call
+    """
+    # warm up (lazy initialization, caches)
+    process(image)
+
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        process(image)
+        times.append(time.perf_counter() - t_start)
+
+    # per stage breakdown of one call
+    timer = StageTimer()
+    process(image, timer=timer)
+    stages = {}
+    for record in timer.records:
+        stages[record["stage"]] = \
+            stages.get(record["stage"], 0.0) + record["time"]
+
+    # tracemalloc slows down the call, measure memory in a separate run
+    tracemalloc.start()
+    process(image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = float(np.mean(times))
+    return {
+        "repeat": repeat,
+        "mean": mean,
+        "min": float(np.min(times)),
+        "median": float(np.median(times)),
+        "fps": 1.0 / mean if mean > 0 else 0.0,
+        "mpix_per_s": image.shape[0] * image.shape[1] / 1e6 / mean
+            if mean > 0 else 0.0,
+        "peak_mem_mb": peak / 2**20,
+        "stages": stages,
+    }
+
+
+def run_benchmarks(cases=None, resolutions=None, repeat=3):
+    """Run the benchmark cases over the resolutions
+
+    Parameters
+    ----------
+    cases : list or None
+        Names of the cases from CASES.  None runs all of them.
+
+    resolutions : list or None
+        Names from RESOLUTIONS.  None uses DEFAULT_RESOLUTIONS.
+
+    repeat : int
+        Number of timed calls per case and resolution
+
+    Returns
+    -------
+    report : dict
+        "meta" describing the machine and "results", one entry per case
+        and resolution.  Cases that can not be loaded (missing optional
+        dependency) are listed with a "skipped" reason.
+    """
+    if cases is None:
+        cases = list(CASES)
+    if resolutions is None:
+        resolutions = DEFAULT_RESOLUTIONS
+
+    results = []
+    for case in cases:
+        try:
+            process = CASES[case]()
+        except ImportError as err:
+            results.append({"case": case, "skipped": str(err)})
+            continue
+
+        for res in resolutions:
+            height, width = RESOLUTIONS[res]
+            image = synthetic_image(height, width)
+            entry = {"case": case, "resolution": res,
+                "shape": list(image.shape)}
+            entry.update(time_process(process, image, repeat))
+            results.append(entry)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "cv_threads": cv2.getNumThreads(),
+        },
+        "results": results,
+    }
+
+
+def compare_smoothing(resolutions=None, repeat=3):
+    """Quality versus speed of the cartoonify smoothing engines
+
+    Parameters
+    ----------
+    resolutions : list or None
+        Names from RESOLUTIONS.  None uses DEFAULT_RESOLUTIONS.
+
+    repeat : int
+        Number of timed calls per engine
+
+    Returns
+    -------
+    results : list
+        Per resolution and engine, the mean time of the smoothing, the
+        speed up and the PSNR of the smoothed and cartoon images against
+        the reference "bilateral" engine.
+    """
+    from py_imagelab.cartoon.cartoon import cartoonify_process, _smooth
+    from py_imagelab.cartoon.cartoon import DEFAULT_CARTOONIFY
+    from py_imagelab.cartoon.cartoon import SMOOTHING_ENGINES
+    if resolutions is None:
+        resolutions = DEFAULT_RESOLUTIONS
+
+    spec = DEFAULT_CARTOONIFY
+    results = []
+    for res in resolutions:
+        height, width = RESOLUTIONS[res]
+        image = synthetic_image(height, width)
+
+        reference = None
+        for engine in SMOOTHING_ENGINES:
+            smooth = lambda im: _smooth(im, spec["bilateral_stages"],
+                spec["bilateral_diameter"], spec["bilateral_sigma_color"],
+                spec["bilateral_sigma_space"], engine, spec["smooth_levels"])
+            stats = time_process(lambda im, timer=None: smooth(im), image,
+                repeat)
+            smoothed = smooth(image)
+            cartoon, _ = cartoonify_process(image,
+                **dict(spec, smoothing=engine))
+
+            entry = {"resolution": res, "engine": engine,
+                "mean": stats["mean"]}
+            if reference is None:
+                reference = (entry["mean"], smoothed, cartoon)
+            else:
+                entry["speed_up"] = reference[0] / entry["mean"]
+                entry["psnr_smoothed"] = cv2.PSNR(smoothed, reference[1])
+                entry["psnr_cartoon"] = cv2.PSNR(cartoon, reference[2])
+            results.append(entry)
+
+    return results
+
+
+def compare_grabcut(resolutions=None, levels=(1, 2)):
+    """Time and accuracy of the coarse to fine GrabCut
+
+    Parameters
+    ----------
+    resolutions : list or None
+        Names from RESOLUTIONS.  None uses DEFAULT_RESOLUTIONS.
+
+    levels : sequence
+        Pyramid levels of the coarse to fine mode to compare
+
+    Returns
+    -------
+    results : list
+        Per resolution and level (0 = full resolution) the time, the
+        IoU of the foreground against the full resolution result and
+        against the true foreground of synthetic_scene.
+    """
+    from py_imagelab.segmentation.foreground_extraction import Foreground
+    if resolutions is None:
+        resolutions = DEFAULT_RESOLUTIONS
+
+    def iou(mask_a, mask_b):
+        return float((mask_a & mask_b).sum()) / max(1, (mask_a | mask_b).sum())
+
+    results = []
+    for res in resolutions:
+        height, width = RESOLUTIONS[res]
+        image, truth = synthetic_scene(height, width)
+
+        reference = None
+        for level in (0,) + tuple(levels):
+            # GrabCut initializes its GMMs with k-means
+            cv2.setRNGSeed(0)
+            t_start = time.perf_counter()
+            out, _ = Foreground(levels=level).extract_foreground(image)
+            elapsed = time.perf_counter() - t_start
+
+            mask = out.any(axis=2)
+            if reference is None:
+                reference = mask
+            results.append({"resolution": res, "levels": level,
+                "time": elapsed, "iou_full": iou(mask, reference),
+                "iou_truth": iou(mask, truth)})
+    return results
+
+
+def compare_batch(n_images=16, workers=None, resolution="vga"):
+    """Throughput of cartoonify_batch against a serial loop
+
+    Parameters
+    ----------
+    n_images : int
+        Number of images of the batch
+
+    workers : int or None
+        Threads of cartoonify_batch, None uses all cores
+
+    resolution : str
+        Name from RESOLUTIONS
+
+    Returns
+    -------
+    result : dict
+        Images per second of the serial loop and the batch, the speed up
+        and whether the outputs are identical
+    """
+    from py_imagelab.cartoon.cartoon import cartoonify_batch, cartoonify_process
+    height, width = RESOLUTIONS[resolution]
+    images = np.stack([synthetic_image(height, width, seed=i)
+        for i in range(n_images)])
+
+    t_start = time.perf_counter()
+    serial = [cartoonify_process(image)[0] for image in images]
+    t_serial = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    batch = cartoonify_batch(images, workers=workers)
+    t_batch = time.perf_counter() - t_start
+
+    return {"resolution": resolution, "images": n_images,
+        "workers": workers or os.cpu_count(),
+        "serial_fps": n_images / t_serial, "batch_fps": n_images / t_batch,
+        "speed_up": t_serial / t_batch,
+        "identical": all(np.array_equal(a, b) for a, b in zip(serial, batch))}
+
+
+def compare(report, baseline, tolerance=0.1):
+    """Compare a report against a baseline report
+
+    Parameters
+    ----------
+    report : dict
+        Output of run_benchmarks
+
+    baseline : dict
+        A previously saved report
+
+    tolerance : float
+        Relative slow down of the mean time reported as a regression
+
+    Returns
+    -------
+    comparison : list
+        One dict per case/resolution found in both reports with the
+        "ratio" of the mean times (< 1 is faster) and "regression" flag
+    """
+    base = {(r["case"], r["resolution"]): r
+        for r in baseline["results"] if "skipped" not in r}
+
+    comparison = []
+    for entry in report["results"]:
+        if "skipped" in entry:
+            continue
+        key = (entry["case"], entry["resolution"])
+        if key not in base:
+            continue
+
+        ratio = entry["mean"] / base[key]["mean"]
+        comparison.append({
+            "case": entry["case"],
+            "resolution": entry["resolution"],
+            "mean": entry["mean"],
+            "baseline_mean": base[key]["mean"],
+            "ratio": ratio,
+            "regression": ratio > 1 + tolerance,
+        })
+    return comparison
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES),
+        help="Cases to run (default all)")
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS),
+        default=DEFAULT_RESOLUTIONS, help="Resolutions to run")
+    parser.add_argument("--repeat", default=3, type=int,
+        help="Number of timed calls per case")
+    parser.add_argument("--output", default="",
+        help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--baseline", default="",
+        help="Compare against this baseline report")
+    parser.add_argument("--save-baseline", default="",
+        help="Save the report as a baseline file")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+        help="Relative slow down reported as a regression")
+    parser.add_argument("--smoothing", action="store_true",
+        help="Also compare speed and quality of the smoothing engines")
+    parser.add_argument("--grabcut", action="store_true",
+        help="Also compare the coarse to fine GrabCut to full resolution")
+    parser.add_argument("--batch", action="store_true",
+        help="Also compare cartoonify_batch to a serial loop")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.cases, args.resolutions, args.repeat)
+    if args.smoothing:
+        report["smoothing"] = compare_smoothing(args.resolutions,
+            args.repeat)
+    if args.grabcut:
+        report["grabcut"] = compare_grabcut(args.resolutions)
+    if args.batch:
+        report["batch"] = compare_batch()
+
+    n_regress = 0
+    if args.baseline:
+        with open(args.baseline) as f_in:
+            baseline = json.load(f_in)
+        report["comparison"] = compare(report, baseline, args.tolerance)
+        n_regress = sum(c["regression"] for c in report["comparison"])
+
+    out_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f_out:
+            f_out.write(out_json)
+    else:
+        print(out_json)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f_out:
+            f_out.write(out_json)
+
+    # non zero exit on regressions, so it can gate a CI job
+    return 1 if n_regress else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
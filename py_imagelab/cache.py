@@ -0,0 +1,362 @@
+"""Persistent cache of the results of run_process
+
+The results are addressed by a key hashing the content of the input
+file, the identity of the process (and the state of the object of a
+bound method), its parameters and the OpenCV version.  A manifest
+records the entries, their size and last use, the content hash of the
+inputs (by path, size and modification time, so unchanged files are not
+read again) and the key each output file was produced with.  A re-run
+only processes the new or changed files, or all files if the process
+parameters changed.
+
+StageCache is the in memory counterpart for the intermediate stages of
+a process (see cartoonify_process).
+
+Usage::
+
+    cache = ResultCache("/tmp/imagelab_cache", max_bytes=2 << 30)
+    key = cache.key(in_path, process, params)
+    if not cache.restore(key, out_path):
+        ...  # process and write out_path
+        cache.store(key, out_path)
+    cache.save()
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+# parameters that do not change the result
+_IGNORED_PARAMS = ("timer", "workspace", "stage_cache")
+
+
+def _qualified_name(func):
+    """Module and qualified name of a function or class"""
+    module = getattr(func, "__module__", "") or ""
+    if module == "__main__":
+        # same identity with python -m and as a library
+        spec = getattr(sys.modules["__main__"], "__spec__", None)
+        if spec is not None:
+            module = spec.name
+    name = getattr(func, "__qualname__", type(func).__name__)
+    return "%s.%s" % (module, name)
+
+
+def _object_state(obj):
+    """Class and state (__getstate__ or attributes) of an object"""
+    state = obj.__getstate__() if hasattr(obj, "__getstate__") else None
+    if state is None:
+        state = getattr(obj, "__dict__", {})
+    return {"class": _qualified_name(type(obj)), "state": state}
+
+
+def _stable(value):
+    """JSON fallback keeping the keys stable across runs
+
+    Nested objects are described recursively by their state, so the
+    settings of i.e. the detector of a FaceTracker are part of the key.
+    Bound methods are described by their function and object, arrays by
+    a hash of their content.  Objects without state (i.e. OpenCV
+    classifiers, built from the other attributes) are replaced by their
+    type name, their repr holds memory addresses.
+    """
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes())
+        return {"ndarray": digest.hexdigest(), "shape": value.shape,
+            "dtype": str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+
+    owner = getattr(value, "__self__", None)
+    if callable(value) and hasattr(value, "__func__") and owner is not None:
+        return {"method": _qualified_name(value.__func__),
+            "self": _object_state(owner)}
+    if callable(value) and hasattr(value, "__qualname__"):
+        return _qualified_name(value)
+    getstate = getattr(type(value), "__getstate__", None)
+    if getattr(value, "__dict__", None) is not None or (getstate is not None
+            and getstate is not getattr(object, "__getstate__", None)):
+        return _object_state(value)
+    return type(value).__name__
+
+
+def process_identity(process):
+    """Stable description of a process for the cache key
+
+    Parameters
+    ----------
+    process : func
+        A function or bound method
+
+    Returns
+    -------
+    identity : str
+        Module and qualified name, plus the state of the object of a
+        bound method (__getstate__ or its attributes), recursively
+    """
+    identity = _qualified_name(process)
+    owner = getattr(process, "__self__", None)
+    if owner is not None:
+        identity += json.dumps(_object_state(owner)["state"],
+            sort_keys=True, default=_stable)
+    return identity
+
+
+class ResultCache():
+    """Content addressed cache of output files with a size bound
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory, created if needed
+
+    max_bytes : int
+        The least recently used entries are evicted beyond this size
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.manifest_file = os.path.join(self.directory, "manifest.json")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # entries: key -> {"file", "size", "last_used"}
+        # inputs: path -> {"size", "mtime", "sha"}
+        # outputs: path -> key
+        self.manifest = {"entries": {}, "inputs": {}, "outputs": {}}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file) as f_in:
+                self.manifest.update(json.load(f_in))
+        self.hits = 0
+        self.misses = 0
+
+    def file_hash(self, filename):
+        """SHA-256 of the file content, reused while the file is unchanged
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        known = self.manifest["inputs"].get(filename)
+        if known is not None and known["size"] == stat.st_size and \
+                known["mtime"] == stat.st_mtime:
+            return known["sha"]
+
+        sha = hashlib.sha256()
+        with open(filename, "rb") as f_in:
+            for chunk in iter(lambda: f_in.read(1 << 20), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        self.manifest["inputs"][filename] = {"size": stat.st_size,
+            "mtime": stat.st_mtime, "sha": digest}
+        return digest
+
+    def key(self, in_path, process, params=None, **extra):
+        """Cache key of processing a file
+
+        Parameters
+        ----------
+        in_path : str
+            The input file
+
+        process : func
+            The process of run_process
+
+        params : dict or None
+            Keyword arguments of the process
+
+        extra : dict
+            Other settings changing the result (i.e. down, output type)
+
+        Returns
+        -------
+        key : str
+            Hex digest
+        """
+        params = {k: v for k, v in (params or {}).items()
+            if k not in _IGNORED_PARAMS}
+        description = json.dumps({
+            "input": self.file_hash(in_path),
+            "process": process_identity(process),
+            "params": params,
+            "extra": extra,
+            "opencv": cv2.__version__,
+        }, sort_keys=True, default=_stable)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def is_current(self, key, out_path):
+        """True if out_path exists and was produced with this key"""
+        out_path = os.path.abspath(out_path)
+        return os.path.isfile(out_path) and \
+            self.manifest["outputs"].get(out_path) == key
+
+    def restore(self, key, out_path):
+        """Write the cached result of key to out_path
+
+        Returns
+        -------
+        hit : bool
+            False if the key is not cached
+        """
+        entry = self.manifest["entries"].get(key)
+        if self.is_current(key, out_path):
+            # left as is by a previous run (even if since evicted)
+            self.hits += 1
+            if entry is not None:
+                entry["last_used"] = time.time()
+            return True
+
+        if entry is not None:
+            cached = os.path.join(self.directory, entry["file"])
+            if not os.path.isfile(cached):
+                # removed behind our back
+                del self.manifest["entries"][key]
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        entry["last_used"] = time.time()
+        shutil.copyfile(cached, out_path)
+        self.manifest["outputs"][os.path.abspath(out_path)] = key
+        return True
+
+    def store(self, key, out_path):
+        """Add the result file out_path under key and evict if needed"""
+        name = key + os.path.splitext(out_path)[1]
+        shutil.copyfile(out_path, os.path.join(self.directory, name))
+        self.manifest["entries"][key] = {"file": name,
+            "size": os.path.getsize(out_path), "last_used": time.time()}
+        self.manifest["outputs"][os.path.abspath(out_path)] = key
+        self.evict()
+
+    @property
+    def size(self):
+        """Total size of the cached files"""
+        return sum(e["size"] for e in self.manifest["entries"].values())
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_bytes"""
+        entries = self.manifest["entries"]
+        total = self.size
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            entry = entries.pop(key)
+            total -= entry["size"]
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except OSError:
+                pass
+
+    def save(self):
+        """Evict down to max_bytes and write the manifest (atomically)"""
+        self.evict()
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w") as f_out:
+            json.dump(self.manifest, f_out)
+        os.replace(tmp_file, self.manifest_file)
+
+
+def image_fingerprint(image):
+    """Hash of the content, shape and type of an image
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image (views are hashed by their content)
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(("%s%s" % (image.shape, image.dtype)).encode())
+    digest.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+    return digest.hexdigest()
+
+
+class StageCache():
+    """In memory LRU cache of intermediate arrays with a size bound
+
+    Used by cartoonify_process (``stage_cache`` keyword argument) to
+    keep the result of each stage, keyed by the image fingerprint and
+    the parameters the stage depends on, so changing a late stage
+    parameter (i.e. the threshold constant) does not rerun the early
+    stages.  The cached arrays are read-only.  Safe to share between
+    threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The least recently used arrays are evicted beyond this size
+    """
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The array of key (now most recently used) or None"""
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, copy=False):
+        """Add an array, evicting the least recently used beyond max_bytes
+
+        Parameters
+        ----------
+        key : hashable
+            The key, i.e. (stage, fingerprint, params)
+
+        value : np.ndarray
+            The array, set read-only
+
+        copy : bool
+            Store a copy (i.e. of a Workspace buffer)
+
+        Returns
+        -------
+        value : np.ndarray
+            The cached array
+        """
+        if copy:
+            value = value.copy()
+        value.flags.writeable = False
+        if value.nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return value
+
+    def clear(self):
+        """Remove all the arrays"""
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
@@ -8,8 +8,14 @@ References
 import numpy as np
 import cv2
 import os
-from py_imagelab.util import get_parser, run_process
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from py_imagelab.util import get_parser, process_options, run_process
 from py_imagelab.test_with_webcam import test_webcam
+from py_imagelab.workspace import Workspace, get_buffer
+from py_imagelab.cache import StageCache, image_fingerprint
+from py_imagelab.loader import choose_down, load_image, read_image_info
+from py_imagelab.segmentation.detection_util import merge_boxes
 DEFAULT_CARTOONIFY = {
     "bilateral_stages": 7,
     "bilateral_diameter": 9,
@@ -18,7 +24,211 @@ DEFAULT_CARTOONIFY = {
     "blur_kernal_size":9,
     "adaptive_thresh_block": 9,
     "adaptive_thresh_const": 2,
+    "smoothing": "bilateral",
+    "smooth_levels": 1,
 }
+SMOOTHING_ENGINES = ("bilateral", "single", "pyramid")
+
+
+def _guided_upsample(image_rgb, smoothed, levels, radius=2, eps=1e-4,
+        workspace=None):
+    """Upsample a smoothed pyramid level guided by the original image
+
+    Fast guided filter: the linear coefficients of the guided filter
+    between the gray image and the smoothed image are fit at the reduced
+    level, upsampled with pyrUp and applied to the full resolution gray
+    image, which restores the edges lost by the pyramid.
+
+    Parameters
+    ----------
+    image_rgb : np.ndarray
+        Full resolution image (the guide)
+
+    smoothed : np.ndarray
+        The smoothed image at pyramid level `levels`
+
+    levels : int
+        Number of pyrDown between image_rgb and smoothed
+
+    radius : int
+        Radius of the box filters at the reduced level
+
+    eps : float
+        Regularization, larger values smooth more across edges
+
+    workspace : Workspace or None
+        If provided, the full resolution arrays are written to its
+        buffers
+
+    Returns
+    -------
+    out : np.ndarray
+        The smoothed image at full resolution
+    """
+    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY,
+        dst=get_buffer(workspace, "guide_gray", image_rgb.shape[:2]))
+    gray_low = gray
+    sizes = []
+    for i in range(levels):
+        sizes.append((gray_low.shape[1], gray_low.shape[0]))
+        gray_low = cv2.pyrDown(gray_low, dst=get_buffer(workspace,
+            "guide_gray%d" % i, smoothed.shape[:2]) if i == levels - 1
+            else None)
+
+    def low(name, channels=1):
+        # float buffer at the reduced level
+        return get_buffer(workspace, "guide_" + name,
+            smoothed.shape[:2] + ((channels,) if channels > 1 else ()),
+            np.float32)
+
+    # --------------  fit linear coefficients at reduced level  -------------
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    channels = smoothed.shape[2]
+    guide = np.multiply(gray_low, np.float32(1. / 255), out=low("i"))
+    src = np.multiply(smoothed, np.float32(1. / 255), out=low("p", channels))
+    mean_i = cv2.boxFilter(guide, -1, ksize, dst=low("mean_i"))
+    mean_p = cv2.boxFilter(src, -1, ksize, dst=low("mean_p", channels))
+    tmp = np.multiply(src, guide[:, :, np.newaxis], out=low("tmp", channels))
+    corr_ip = cv2.boxFilter(tmp, -1, ksize, dst=low("corr_ip", channels))
+    tmp_i = np.multiply(guide, guide, out=low("tmp_i"))
+    var_i = cv2.boxFilter(tmp_i, -1, ksize, dst=low("var_i"))
+    var_i -= np.multiply(mean_i, mean_i, out=tmp_i)
+
+    # a = (corr_ip - mean_p * mean_i) / (var_i + eps), in place
+    a = corr_ip
+    a -= np.multiply(mean_p, mean_i[:, :, np.newaxis], out=tmp)
+    var_i += eps
+    a /= var_i[:, :, np.newaxis]
+
+    # b = mean_p - a * mean_i, in place
+    b = mean_p
+    b -= np.multiply(a, mean_i[:, :, np.newaxis], out=tmp)
+
+    # ---------------------  apply at full resolution  ----------------------
+    a = cv2.boxFilter(a, -1, ksize, dst=low("a", channels))
+    b = cv2.boxFilter(b, -1, ksize, dst=low("b", channels))
+    for i, size in enumerate(reversed(sizes)):
+        shape = (size[1], size[0], a.shape[2])
+        a = cv2.pyrUp(a, dstsize=size,
+            dst=get_buffer(workspace, "guide_a%d" % i, shape, np.float32))
+        b = cv2.pyrUp(b, dstsize=size,
+            dst=get_buffer(workspace, "guide_b%d" % i, shape, np.float32))
+    gray_f = np.multiply(gray, np.float32(1. / 255),
+        out=get_buffer(workspace, "guide_gray_f", gray.shape, np.float32))
+
+    # in place in the upsampled coefficients
+    out = np.multiply(a, gray_f[:, :, np.newaxis], out=a)
+    out += b
+    np.clip(out, 0, 1, out=out)
+    out *= 255
+    out += 0.5
+    smoothed = get_buffer(workspace, "guide_out", out.shape)
+    if smoothed is None:
+        smoothed = np.empty(out.shape, np.uint8)
+    np.copyto(smoothed, out, casting="unsafe")
+    return smoothed
+
+
+def _smooth(image_rgb, n_bilat, diameter, sigma_color, sigma_space,
+        engine="bilateral", levels=1, workspace=None, cancelled=None):
+    """Edge preserving smoothing stage of cartoonify_process
+
+    Parameters
+    ----------
+    image_rgb : np.ndarray
+        The input image
+
+    n_bilat : int
+        Number of bilateral filter passes
+
+    diameter, sigma_color, sigma_space : int
+        Bilateral filter parameters of each pass
+
+    engine : str
+        One of SMOOTHING_ENGINES.
+
+        * "bilateral" - n_bilat passes at full resolution (reference)
+        * "single" - one pass with the sigmas scaled by sqrt(n_bilat),
+          the variance of n passes.
+        * "pyramid" - the n_bilat passes at pyramid level `levels` with
+          the spatial parameters scaled down, then guided upsampling.
+
+    levels : int
+        Pyramid levels for the "pyramid" engine
+
+    workspace : Workspace or None
+        If provided, the filters write to its buffers
+
+    cancelled : func or None
+        Checked before each bilateral pass, CancelledError is raised
+        when it returns true
+
+    Returns
+    -------
+    smoothed : np.ndarray
+        The smoothed image
+    """
+    def check():
+        if cancelled is not None and cancelled():
+            raise CancelledError()
+
+    if engine == "bilateral":
+        for i in range(n_bilat):
+            check()
+            # the filter is not in place, alternate between two buffers
+            image_rgb = cv2.bilateralFilter(image_rgb, d=diameter,
+                sigmaColor=sigma_color, sigmaSpace=sigma_space,
+                dst=get_buffer(workspace, "smooth%d" % (i % 2),
+                    image_rgb.shape))
+        return image_rgb
+
+    elif engine == "single":
+        scale = np.sqrt(max(n_bilat, 1))
+        return cv2.bilateralFilter(image_rgb, d=diameter,
+            sigmaColor=sigma_color * scale, sigmaSpace=sigma_space * scale,
+            dst=get_buffer(workspace, "smooth0", image_rgb.shape))
+
+    elif engine == "pyramid":
+        smoothed = image_rgb
+        for i in range(levels):
+            shape = ((smoothed.shape[0] + 1) // 2,
+                (smoothed.shape[1] + 1) // 2) + smoothed.shape[2:]
+            smoothed = cv2.pyrDown(smoothed,
+                dst=get_buffer(workspace, "pyr%d" % i, shape))
+
+        # scale the spatial parameters to the reduced level
+        diameter = max(3, (diameter >> levels) | 1)
+        sigma_space = sigma_space / 2 ** levels
+        for i in range(n_bilat):
+            check()
+            smoothed = cv2.bilateralFilter(smoothed, d=diameter,
+                sigmaColor=sigma_color, sigmaSpace=sigma_space,
+                dst=get_buffer(workspace, "smooth%d" % (i % 2),
+                    smoothed.shape))
+        return _guided_upsample(image_rgb, smoothed, levels,
+            workspace=workspace)
+
+    raise ValueError("Unknown smoothing engine (%s)" % engine)
+
+
+def _cache_get(stage_cache, key):
+    """Cached stage output of cartoonify_process, None if not cached"""
+    if stage_cache is None:
+        return None
+    return stage_cache.get(key)
+
+
+def _cache_put(stage_cache, key, value, workspace=None, copy=False):
+    """Cache a stage output of cartoonify_process
+
+    The buffers of the workspace are overwritten by the next call and
+    the input image belongs to the caller, both are cached as a copy.
+    """
+    if stage_cache is None:
+        return value
+    return stage_cache.put(key, value, copy=copy or workspace is not None)
+
+
 def cartoonify_process(image_rgb, **kwargs):
     """Process and image and return cartoonified image
 
@@ -32,13 +242,39 @@ def cartoonify_process(image_rgb, **kwargs):
     the grayscale of the image and adaptive detection before applying
     the enhanced edges on the blurred image.
 
+    The bilateral smoothing dominates the cost.  "smoothing" selects a
+    faster approximation (see _smooth).  Measured on the synthetic 1080p
+    image of py_imagelab.bench (single core), PSNR against the default
+    "bilateral" output::
+
+        engine      time     speed up   PSNR smoothed   PSNR cartoon
+        bilateral   1.83 s   1.0x       -               -
+        single      0.26 s   7.1x       48.1 dB         38.4 dB
+        pyramid     0.17 s   10.8x      41.4 dB         34.0 dB
+
+    Run ``python -m py_imagelab.bench --smoothing`` to reproduce.
+
+    With a StageCache as "stage_cache", the smoothed, median filtered
+    and thresholded images are cached by the image fingerprint and the
+    parameters of the stage and the stages before it.  Changing only
+    the threshold parameters reruns the threshold and combine stages
+    (milliseconds at 1080p instead of seconds), changing the median
+    kernel reruns from the gray conversion.  The combine stage (one
+    bitwise_and) is not cached, so the output is never a cached array.
+
     Parameters
     ----------
     image_rgb : Image
         Image
 
     kwargs : dict
-        Keyword arguments
+        Keyword arguments, see DEFAULT_CARTOONIFY.  An optional "timer"
+        (StageTimer) records the time of each stage.  An optional
+        "workspace" (Workspace) provides the buffers of the stages, the
+        output is one of its rotating buffers.  An optional
+        "stage_cache" (StageCache) memoizes the stages.  An optional
+        "cancelled" function is checked between the smoothing passes,
+        CancelledError is raised when it returns true.
 
     Returns
     -------
@@ -56,29 +292,368 @@ def cartoonify_process(image_rgb, **kwargs):
     blur_kernal_size = kwargs.get("blur_kernal_size", 9)
     adapt_threshold_block = kwargs.get("adaptive_thresh_block", 9)
     adapt_threshold_const = kwargs.get("adaptive_thresh_const", 2)
+    smoothing = kwargs.get("smoothing", "bilateral")
+    smooth_levels = kwargs.get("smooth_levels", 1)
+    timer = kwargs.get("timer")
+    workspace = kwargs.get("workspace")
+    stage_cache = kwargs.get("stage_cache")
+    cancelled = kwargs.get("cancelled")
+    if timer is not None:
+        timer.start()
+    shape = image_rgb.shape
+
+    # each stage is keyed by the image and the parameters up to the stage
+    smooth_key = median_key = edges_key = None
+    if stage_cache is not None:
+        smooth_key = ("smooth", image_fingerprint(image_rgb), n_bilat,
+            bilat_diameter, bilat_sigma_color, bilat_sigma_space, smoothing,
+            smooth_levels)
+        median_key = smooth_key + ("median", blur_kernal_size)
+        edges_key = median_key + ("threshold", adapt_threshold_block,
+            adapt_threshold_const)
 
     # ------------------------  bilateral filter  ---------------------------
-    for _ in range(n_bilat):
-        image_rgb = cv2.bilateralFilter(image_rgb, d=bilat_diameter,
-            sigmaColor=bilat_sigma_color, sigmaSpace=bilat_sigma_space)
+    smoothed = _cache_get(stage_cache, smooth_key)
+    if smoothed is None:
+        smoothed = _smooth(image_rgb, n_bilat, bilat_diameter,
+            bilat_sigma_color, bilat_sigma_space, smoothing, smooth_levels,
+            workspace, cancelled)
+        smoothed = _cache_put(stage_cache, smooth_key, smoothed, workspace,
+            smoothed is image_rgb)
+    image_rgb = smoothed
+    if timer is not None:
+        timer.lap("smooth", image_rgb)
 
-    # -------------------------  median filter  -----------------------------
-    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY)
-    blurred = cv2.medianBlur(gray, blur_kernal_size)
+    edges = _cache_get(stage_cache, edges_key)
+    if edges is None:
+        # -----------------------  median filter  ---------------------------
+        blurred = _cache_get(stage_cache, median_key)
+        if blurred is None:
+            gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY,
+                dst=get_buffer(workspace, "gray", shape[:2]))
+            if timer is not None:
+                timer.lap("gray", gray)
+            blurred = cv2.medianBlur(gray, blur_kernal_size,
+                dst=get_buffer(workspace, "median", shape[:2]))
+            blurred = _cache_put(stage_cache, median_key, blurred, workspace)
+        if timer is not None:
+            timer.lap("median", blurred)
 
-    # ------------------------  enhance edges  ------------------------------
-    edges = cv2.adaptiveThreshold(blurred, 255,
-        cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
-            blockSize=adapt_threshold_block, C=adapt_threshold_const)
+        # ----------------------  enhance edges  ----------------------------
+        edges = cv2.adaptiveThreshold(blurred, 255,
+            cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                blockSize=adapt_threshold_block, C=adapt_threshold_const,
+                dst=get_buffer(workspace, "edges", shape[:2]))
+        edges = _cache_put(stage_cache, edges_key, edges, workspace)
+    if timer is not None:
+        timer.lap("threshold", edges)
 
     # convert back to color
-    edges  = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
+    edges  = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB,
+        dst=get_buffer(workspace, "edges_rgb", shape))
+    if timer is not None:
+        timer.lap("edges_rgb", edges)
 
     # enchance edges
-    cartoon_image = cv2.bitwise_and(image_rgb, edges)
+    cartoon_image = cv2.bitwise_and(image_rgb, edges,
+        dst=get_buffer(workspace, "cartoon", shape, rotate=True))
+    if timer is not None:
+        timer.lap("combine", cartoon_image)
     return cartoon_image, None
 
 
+def cartoon_halo(**kwargs):
+    """Number of border pixels a cartoonify_process output pixel depends on
+
+    The sum of the radii of the smoothing, median and adaptive threshold
+    stages.  A crop extended by this halo on every side gives the same
+    output as the full image inside the original crop.
+
+    Parameters
+    ----------
+    kwargs : dict
+        Keyword arguments of cartoonify_process
+
+    Returns
+    -------
+    halo : int
+        The halo in pixels
+    """
+    n_bilat = kwargs.get("bilateral_stages", 7)
+    bilat_diameter = kwargs.get("bilateral_diameter", 9)
+    blur_kernal_size = kwargs.get("blur_kernal_size", 9)
+    adapt_threshold_block = kwargs.get("adaptive_thresh_block", 9)
+    smoothing = kwargs.get("smoothing", "bilateral")
+    smooth_levels = kwargs.get("smooth_levels", 1)
+
+    if smoothing == "single":
+        halo = bilat_diameter // 2
+
+    elif smoothing == "pyramid":
+        # bilateral passes and the guided filter box filters at the
+        # reduced level plus the 5x5 pyrDown/pyrUp of each level, scaled
+        # to full resolution
+        diameter = max(3, (bilat_diameter >> smooth_levels) | 1)
+        halo = n_bilat * (diameter // 2) + 2 * 2 + 2 * smooth_levels
+        halo *= 2 ** smooth_levels
+
+    else:
+        halo = n_bilat * (bilat_diameter // 2)
+
+    return halo + blur_kernal_size // 2 + adapt_threshold_block // 2
+
+
+def cartoonify_tiled(image_rgb, tile_size=1024, workers=None, **kwargs):
+    """Cartoonify a large image tile by tile
+
+    The image is split into tiles, each tile is extended by the halo of
+    cartoon_halo and processed with cartoonify_process on a thread pool
+    (OpenCV releases the GIL) and the tile centers are stitched into the
+    output.  Only the input, the output and the intermediates of the
+    tiles in flight are held in memory.
+
+    The output matches cartoonify_process pixel for pixel.  For the
+    "pyramid" smoothing the tiles are aligned on the pyramid grid.
+
+    Parameters
+    ----------
+    image_rgb : np.ndarray or str
+        The image or path to the image
+
+    tile_size : int
+        Size of the (square) tiles without halo
+
+    workers : int or None
+        Number of threads, None uses all cores
+
+    kwargs : dict
+        Keyword arguments of cartoonify_process
+
+    Returns
+    -------
+    processed_image : np.ndarray
+        The processed image
+
+    detections : None
+        For the process signature of run_process
+    """
+    if isinstance(image_rgb, str):
+        image_rgb = cv2.imread(image_rgb)
+
+    # the tiles are processed independently, no per stage timing, and
+    # the tiles in flight can not share the workspace buffers
+    kwargs.pop("timer", None)
+    workspace = kwargs.pop("workspace", None)
+    halo = cartoon_halo(**kwargs)
+    if kwargs.get("smoothing") == "pyramid":
+        # align tiles and halo on the pyramid grid
+        align = 2 ** kwargs.get("smooth_levels", 1)
+        tile_size = max(align, tile_size // align * align)
+        halo = -(-halo // align) * align
+
+    height, width = image_rgb.shape[:2]
+    cartoon_image = get_buffer(workspace, "cartoon", image_rgb.shape,
+        rotate=True)
+    if cartoon_image is None:
+        cartoon_image = np.empty_like(image_rgb)
+
+    def run_tile(origin):
+        y0, x0 = origin
+        y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+
+        # tile with halo, clipped to the image (borders are handled the
+        # same as for the full image)
+        hy0, hx0 = max(0, y0 - halo), max(0, x0 - halo)
+        hy1, hx1 = min(height, y1 + halo), min(width, x1 + halo)
+        tile, _ = cartoonify_process(image_rgb[hy0:hy1, hx0:hx1], **kwargs)
+        cartoon_image[y0:y1, x0:x1] = \
+            tile[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+    origins = [(y, x) for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        # list() to raise the exceptions of the tiles
+        list(pool.map(run_tile, origins))
+
+    return cartoon_image, None
+
+
+def cartoonify_regions(image_rgb, boxes=None, mask=None, **kwargs):
+    """Cartoonify only some regions of the image
+
+    Each region is extended by the halo of cartoon_halo, the extended
+    regions are merged where they overlap and processed with
+    cartoonify_process, and the regions are copied into a copy of the
+    input.  The cost scales with the area of the regions instead of the
+    image.  Inside the regions the output matches cartoonify_process
+    pixel for pixel.
+
+    Parameters
+    ----------
+    image_rgb : np.ndarray or str
+        The image or path to the image
+
+    boxes : list or None
+        (x, y, w, h) regions, i.e. the detections of FaceDetectCascade
+        or FaceDetectDlib
+
+    mask : np.ndarray or None
+        If provided (instead of boxes), the non zero pixels are
+        cartoonified, i.e. the mask output of Foreground
+
+    kwargs : dict
+        Keyword arguments of cartoonify_process
+
+    Returns
+    -------
+    processed_image : np.ndarray
+        The image with the cartoonified regions
+
+    detections : None
+        For the process signature of run_process
+    """
+    if isinstance(image_rgb, str):
+        image_rgb = cv2.imread(image_rgb)
+
+    timer = kwargs.pop("timer", None)
+    workspace = kwargs.get("workspace")
+    if timer is not None:
+        timer.start()
+    height, width = image_rgb.shape[:2]
+
+    if mask is not None:
+        # bounding boxes of the connected regions of the mask
+        mask = (mask != 0).view(np.uint8)
+        n_labels, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        boxes = [stats[i, :4] for i in range(1, n_labels)]
+    if boxes is None:
+        boxes = []
+
+    # ---------------  crops of the regions with their halo  ---------------
+    halo = cartoon_halo(**kwargs)
+    align = 1
+    if kwargs.get("smoothing") == "pyramid":
+        # align the crops on the pyramid grid (see cartoonify_tiled)
+        align = 2 ** kwargs.get("smooth_levels", 1)
+
+    regions = []
+    crops = []
+    for box in boxes:
+        x, y, w, h = [int(v) for v in box]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), min(height, y + h)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        regions.append((x0, y0, x1, y1))
+
+        cx0 = max(0, (x0 - halo) // align * align)
+        cy0 = max(0, (y0 - halo) // align * align)
+        cx1 = min(width, -(-(x1 + halo) // align) * align)
+        cy1 = min(height, -(-(y1 + halo) // align) * align)
+        crops.append([cx0, cy0, cx1 - cx0, cy1 - cy0])
+    crops = merge_boxes(crops)
+
+    cartoon_image = get_buffer(workspace, "cartoon_regions",
+        image_rgb.shape, rotate=True)
+    if cartoon_image is None:
+        cartoon_image = image_rgb.copy()
+    else:
+        np.copyto(cartoon_image, image_rgb)
+
+    # ----------------  process the crops and composite  --------------------
+    for (cx, cy, cw, ch) in crops:
+        crop, _ = cartoonify_process(image_rgb[cy:cy + ch, cx:cx + cw],
+            **kwargs)
+        out = cartoon_image[cy:cy + ch, cx:cx + cw]
+        if mask is not None:
+            # the merged crops do not overlap, only the mask pixels of
+            # this crop are its own
+            np.copyto(out, crop,
+                where=mask[cy:cy + ch, cx:cx + cw, np.newaxis] != 0)
+            continue
+
+        for (x0, y0, x1, y1) in regions:
+            if cx <= x0 and x1 <= cx + cw and cy <= y0 and y1 <= cy + ch:
+                out[y0 - cy:y1 - cy, x0 - cx:x1 - cx] = \
+                    crop[y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+    if timer is not None:
+        timer.lap("regions", cartoon_image)
+    return cartoon_image, None
+
+
+def cartoonify_batch(images, workers=None, opencv_threads=1, **kwargs):
+    """Cartoonify a stack of images on a thread pool
+
+    OpenCV releases the GIL in its filters, so the images are processed
+    in parallel by threads.  Each thread keeps a Workspace reused for
+    all the images it processes, so the intermediates are allocated
+    once per thread instead of once per image.
+
+    Parameters
+    ----------
+    images : np.ndarray or list
+        (N, H, W, 3) uint8 array, or list of images or paths to images
+
+    workers : int or None
+        Number of threads, None uses all cores
+
+    opencv_threads : int or None
+        Number of OpenCV threads during the batch (restored after).  The
+        default of 1 avoids oversubscribing the cores with the threads
+        of both OpenCV and the pool.  None keeps the current setting.
+
+    kwargs : dict
+        Keyword arguments of cartoonify_process
+
+    Returns
+    -------
+    processed_images : np.ndarray or list
+        (N, H, W, 3) array of the cartoons if the images have the same
+        shape, otherwise a list
+    """
+    kwargs.pop("timer", None)
+    kwargs.pop("workspace", None)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    images = [load_image(im) if isinstance(im, str) else im for im in images]
+
+    out = None
+    shapes = set(im.shape for im in images)
+    if len(shapes) == 1:
+        # written in place by the threads
+        out = np.empty((len(images),) + shapes.pop(), np.uint8)
+    results = [None] * len(images)
+
+    # one workspace per thread
+    local = threading.local()
+
+    def run_item(i):
+        workspace = getattr(local, "workspace", None)
+        if workspace is None:
+            workspace = local.workspace = Workspace()
+        cartoon, _ = cartoonify_process(images[i], workspace=workspace,
+            **kwargs)
+        if out is not None:
+            out[i] = cartoon
+        else:
+            results[i] = cartoon.copy()
+
+    n_threads = cv2.getNumThreads()
+    if opencv_threads is not None:
+        cv2.setNumThreads(opencv_threads)
+    try:
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            # list() to raise the exceptions of the items
+            list(pool.map(run_item, range(len(images))))
+    finally:
+        cv2.setNumThreads(n_threads)
+
+    return out if out is not None else results
+
+
 def cartoonify(filename, out_size, out_file="/tmp/cartoon.png", **kwargs):
     """Cartoonify an input signal
 
@@ -88,7 +663,9 @@ def cartoonify(filename, out_size, out_file="/tmp/cartoon.png", **kwargs):
         The path to the input image
 
     out_size : tuple
-        The output image size
+        Minimum (height, width) of the output image.  The image is
+        decoded at the smallest pyramid level keeping this size (see
+        choose_down).
 
     out_file : str
         The output filename
@@ -98,21 +675,55 @@ def cartoonify(filename, out_size, out_file="/tmp/cartoon.png", **kwargs):
     cartoonify_process : Function to cartoonify image
     """
     # ------------------  load image and downsample  ------------------------
-    image_rgb = cv2.imread(filename)
+    # the header gives the size, decode directly at the reduced resolution
+    down = choose_down(read_image_info(filename), out_size)
+    image_rgb = load_image(filename, down)
 
-    # identify the downsample
-    down = np.max((int(image_rgb.shape[0] / out_size[0]),
-        int(image_rgb.shape[1] / out_size[1])))
+    # --------------------------  run cartoonify  ---------------------------
+    cartoon_image, _ = cartoonify_process(image_rgb, **kwargs)
 
-    # downsample by Gaussian pyramid
-    for _ in range(down):
-        image_rgb = cv2.pyrDown(image_rgb)
+    # -------------------------  save image  --------------------------------
+    if not cv2.imwrite(out_file, cartoon_image):
+        raise IOError("Unable to write (%s)" % out_file)
 
-    # --------------------------  run carto
-    cartoon_image = cartoonify_process(image_rgb, kwargs)
+def cartoonify_sweep(images, param_sets, stage_cache=None):
+    """Cartoonify images with several parameter sets
+
+    The images are processed one by one with all the parameter sets, the
+    stages shared by parameter sets (i.e. only the threshold differs)
+    are computed once per image through the stage cache.
+
+    Parameters
+    ----------
+    images : list
+        Images or paths to the images
+
+    param_sets : list
+        Keyword arguments of cartoonify_process, one dict per set
+
+    stage_cache : StageCache or None
+        The cache of the stages, None uses a new one of 256 MB
+
+    Returns
+    -------
+    results : list
+        Per image, the list of the outputs of each parameter set
+    """
+    if stage_cache is None:
+        stage_cache = StageCache()
+
+    results = []
+    for image_rgb in images:
+        if isinstance(image_rgb, str):
+            image_rgb = cv2.imread(image_rgb)
+        results.append([cartoonify_process(image_rgb,
+            stage_cache=stage_cache, **params)[0] for params in param_sets])
+    return results
+
+
+# stages of the interface input, kept while moving the sliders
+_GRADIO_CACHE = StageCache(256 << 20)
 
-    # -------------------------  save image  --------------------------------
-    cv2.imwrite(out_file, cartoon_image)
 
 def cartoonify_gradio(img, adapt_thres, blur_size, bilat_dia, bilat_col, bilat_space):
     kwargs = {
@@ -122,28 +733,73 @@ def cartoonify_gradio(img, adapt_thres, blur_size, bilat_dia, bilat_col, bilat_s
         "bilateral_diameter": bilat_dia,
         "bilateral_sigma_color": bilat_col,
         "bilateral_sigma_space": bilat_space,
+        "stage_cache": _GRADIO_CACHE,
     }
     output_image,_ = cartoonify_process(img, **kwargs)
 
     return output_image
 
-def run_gradio(share=False):
+def run_gradio(share=False, progressive=False, workers=2):
+    """Launch the Gradio interface
+
+    Parameters
+    ----------
+    share : bool
+        Create a public link
+
+    progressive : bool
+        Keep the input size, first show a low resolution preview then
+        the full resolution result (see ProgressiveCartoon).  The
+        requests made stale by moving a slider again are dropped.
+
+    workers : int
+        Number of processing threads shared by the users of the
+        progressive interface
+    """
     import gradio as gr
+    sliders = [
+        gr.inputs.Slider(1, 20, 1),         # adapt thres
+        #gr.inputs.Slider(3, 20, 2),         # adapt block
+        gr.inputs.Slider(1, 21, 2),         # blur size
+        gr.inputs.Slider(1, 21, 1),         # bilat dia
+        gr.inputs.Slider(1, 21, 1),         # bilat color
+        gr.inputs.Slider(1, 21, 1),         # bilat space
+    ]
+
+    if not progressive:
+        iface = gr.Interface(
+            fn=cartoonify_gradio,
+            inputs=[gr.inputs.Image(shape=(512,512))] + sliders,
+            outputs=["image"]
+        )
+        iface.launch(share=share)
+        return
+
+    from py_imagelab.cartoon.preview import ProgressiveCartoon
+    preview = ProgressiveCartoon(workers, stage_cache=_GRADIO_CACHE)
+
+    def cartoonify_progressive(img, adapt_thres, blur_size, bilat_dia,
+            bilat_col, bilat_space, request: gr.Request):
+        if img is None:
+            return
+        # the blur size must be odd
+        blur_size = int(blur_size) | 1
+        yield from preview.run(img,
+            session=getattr(request, "session_hash", None),
+            adaptive_thresh_const=adapt_thres,
+            blur_kernal_size=blur_size,
+            bilateral_diameter=bilat_dia,
+            bilateral_sigma_color=bilat_col,
+            bilateral_sigma_space=bilat_space)
+
     iface = gr.Interface(
-        fn=cartoonify_gradio,
-        inputs=[
-            gr.inputs.Image(shape=(512,512)),
-            gr.inputs.Slider(1, 20, 1),         # adapt thres
-            #gr.inputs.Slider(3, 20, 2),         # adapt block
-            gr.inputs.Slider(1, 21, 2),         # blur size
-            gr.inputs.Slider(1, 21, 1),         # bilat dia
-            gr.inputs.Slider(1, 21, 1),         # bilat color
-            gr.inputs.Slider(1, 21, 1),         # bilat space
-
-        ],
-        outputs=["image"]
+        fn=cartoonify_progressive,
+        inputs=[gr.inputs.Image()] + sliders,
+        outputs=["image"],
+        live=True
     )
-
+    # the queue streams the generator outputs
+    iface.queue()
     iface.launch(share=share)
 
 if __name__ == "__main__":
@@ -151,6 +807,10 @@ if __name__ == "__main__":
     parser = get_parser()
     parser.add_argument("--gradio", action="store_true")
     parser.add_argument("--share", action="store_true")
+    parser.add_argument("--progressive", action="store_true",
+        help="Gradio preview at low resolution, then full resolution")
+    parser.add_argument("--gradio_workers", default=2, type=int,
+        help="Processing threads of the progressive Gradio interface")
     parser.add_argument("--bi_stages", default=7, type=int,
         help="Number of stages of bilateral filter")
     parser.add_argument("--bi_diameter", default=9, type=int,
@@ -165,10 +825,16 @@ if __name__ == "__main__":
         help="Adaptive threshold block size")
     parser.add_argument("--adapt_thresh_const", default=2, type=int,
         help="Adaptive threshold constant")
+    parser.add_argument("--smoothing", default="bilateral",
+        choices=SMOOTHING_ENGINES, help="Smoothing engine")
+    parser.add_argument("--smooth_levels", default=1, type=int,
+        help="Pyramid levels of the pyramid smoothing engine")
+    parser.add_argument("--tile_size", default=0, type=int,
+        help="Process in tiles of this size (0 = whole image)")
     args = parser.parse_args()
 
     if args.gradio:
-        run_gradio(args.share)
+        run_gradio(args.share, args.progressive, args.gradio_workers)
     else:
         spec = {
             "bilateral_stages": args.bi_stages,
@@ -178,13 +844,17 @@ if __name__ == "__main__":
             "blur_kernal_size":args.blur_kernal_size,
             "adaptive_thresh_block": args.adapt_thresh_block,
             "adaptive_thresh_const": args.adapt_thresh_const,
+            "smoothing": args.smoothing,
+            "smooth_levels": args.smooth_levels,
         }
 
+        process = cartoonify_process
+        if args.tile_size > 0:
+            process = cartoonify_tiled
+            spec["tile_size"] = args.tile_size
+
         run_process(
-            process=cartoonify_process,
+            process=process,
             params=spec,
             title="Cartoonify",
-            in_file=args.input,
-            out_file=args.output,
-            down=args.down,
-            overwrite=args.overwrite)
+            **process_options(args))
@@ -0,0 +1,179 @@
+"""Progressive cartoonify for interactive tuning
+
+ProgressiveCartoon first returns the cartoon of a pyramid reduced copy
+of the image, with the kernel sizes scaled to the reduced level and
+upsampled to the input size, then the full resolution cartoon.  A new
+request of the same session (i.e. a slider moved again) makes the
+previous one stale, it is dropped at its next smoothing pass.  The
+requests of all sessions share a bounded thread pool::
+
+    preview = ProgressiveCartoon(workers=2)
+    for image in preview.run(img, session="user", adaptive_thresh_const=4):
+        show(image)
+"""
+import cv2
+import itertools
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from py_imagelab.cache import StageCache
+from py_imagelab.cartoon.cartoon import cartoonify_process
+
+
+def preview_levels(shape, max_pixels=256 * 256):
+    """Number of pyramid levels to reduce an image to max_pixels
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image
+
+    max_pixels : int
+        Maximum number of pixels of the preview
+
+    Returns
+    -------
+    levels : int
+        Number of pyrDown, 0 if the image is small enough
+    """
+    height, width = shape[:2]
+    levels = 0
+    while height * width > max_pixels:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        levels += 1
+    return levels
+
+
+def preview_params(params, levels):
+    """Scale the spatial parameters of cartoonify_process to a pyramid level
+
+    Parameters
+    ----------
+    params : dict
+        Keyword arguments of cartoonify_process
+
+    levels : int
+        Number of pyrDown of the preview
+
+    Returns
+    -------
+    params : dict
+        The keyword arguments for the reduced image
+    """
+    def odd(size):
+        # odd kernel size of at least 3
+        return max(3, (size >> levels) | 1)
+
+    params = dict(params)
+    params["bilateral_diameter"] = odd(params.get("bilateral_diameter", 9))
+    params["bilateral_sigma_space"] = \
+        params.get("bilateral_sigma_space", 7) / 2 ** levels
+    params["blur_kernal_size"] = odd(params.get("blur_kernal_size", 9))
+    params["adaptive_thresh_block"] = odd(
+        params.get("adaptive_thresh_block", 9))
+    return params
+
+
+class ProgressiveCartoon():
+    """Preview then full resolution cartoonify with stale request dropping
+
+    Parameters
+    ----------
+    workers : int
+        Number of threads shared by all the sessions
+
+    max_pixels : int
+        Maximum number of pixels of the preview, no preview for smaller
+        images
+
+    stage_cache : StageCache or None
+        Cache of the stages shared by the requests (see
+        cartoonify_process), None uses a new one of 256 MB
+    """
+    def __init__(self, workers=2, max_pixels=256 * 256, stage_cache=None):
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pixels = max_pixels
+        self.stage_cache = stage_cache or StageCache()
+        # session -> generation of its latest request
+        self.generations = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def is_stale(self, session, generation):
+        """True if the session made a newer request"""
+        with self._lock:
+            return self.generations.get(session) != generation
+
+    def _process(self, image_rgb, levels, stale, params):
+        """Cartoon at pyramid level levels, None once the request is stale
+        """
+        if stale():
+            return None
+        small = image_rgb
+        for _ in range(levels):
+            small = cv2.pyrDown(small)
+        try:
+            cartoon, _ = cartoonify_process(small,
+                stage_cache=self.stage_cache, cancelled=stale,
+                **(preview_params(params, levels) if levels else params))
+        except CancelledError:
+            return None
+
+        if levels:
+            cartoon = cv2.resize(cartoon,
+                (image_rgb.shape[1], image_rgb.shape[0]),
+                interpolation=cv2.INTER_LINEAR)
+        return cartoon
+
+    def run(self, image_rgb, session=None, **params):
+        """Cartoonify progressively
+
+        Parameters
+        ----------
+        image_rgb : np.ndarray
+            The image
+
+        session : hashable
+            Identifies the requests of a user, a new request makes the
+            previous ones of the session stale
+
+        params : dict
+            Keyword arguments of cartoonify_process
+
+        Yields
+        ------
+        cartoon : np.ndarray
+            The preview (if the image has more than max_pixels), then
+            the full resolution cartoon.  Nothing more is yielded once
+            the request is stale.
+        """
+        with self._lock:
+            generation = next(self._counter)
+            self.generations[session] = generation
+
+        def stale():
+            return self.is_stale(session, generation)
+
+        try:
+            # queued on the shared pool, a stale request is dropped when
+            # it reaches a worker
+            levels = preview_levels(image_rgb.shape, self.max_pixels)
+            if levels > 0:
+                preview = self.pool.submit(self._process, image_rgb, levels,
+                    stale, params).result()
+                if preview is None:
+                    return
+                yield preview
+
+            cartoon = self.pool.submit(self._process, image_rgb, 0, stale,
+                params).result()
+            if cartoon is not None and not stale():
+                yield cartoon
+
+        finally:
+            with self._lock:
+                if self.generations.get(session) == generation:
+                    del self.generations[session]
+
+    def shutdown(self):
+        """Stop the worker threads"""
+        self.pool.shutdown()
@@ -0,0 +1,247 @@
+"""Image loading at reduced resolution with prefetching
+
+The JPEG decoder of OpenCV can scale the DCT by 1/2, 1/4 or 1/8 while
+decoding (IMREAD_REDUCED_COLOR_*), which is much cheaper than decoding
+the full image and throwing most of it away with pyrDown.  load_image
+maps the pyramid levels of ``down`` onto these flags and only runs
+pyrDown for the levels beyond 8x.  read_image_info reads the size and
+EXIF orientation from the file header without decoding, so the level
+can be chosen from a target size (choose_down).  prefetch loads the
+upcoming files of a list on a thread pool.
+"""
+import cv2
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# number of pyramid levels -> reduced decode flag
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_REDUCED_COLOR_2,
+    2: cv2.IMREAD_REDUCED_COLOR_4,
+    3: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# JPEG start of frame markers (the others of 0xC0-0xCF are not frames)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def load_image(filename, down=0, reduced=True):
+    """Load a color image downsampled by down pyramid levels
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+
+    down : int
+        Number of pyramid levels (each halves the size)
+
+    reduced : bool
+        Decode JPEG files at reduced resolution for up to 3 levels.  The
+        result has the size of the pyrDown chain but differs slightly in
+        value.  Other formats (decoded at full size by OpenCV, then
+        resized with different rounding) and False decode the full
+        image and run pyrDown down times.
+
+    Returns
+    -------
+    image : np.ndarray
+        The BGR image
+    """
+    levels = min(down, 3) if reduced and _is_jpeg(filename) else 0
+    image = cv2.imread(filename, REDUCED_FLAGS.get(levels, cv2.IMREAD_COLOR))
+    if image is None:
+        raise IOError("Unable to read image (%s)" % filename)
+
+    for _ in range(down - levels):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def _is_jpeg(filename):
+    """True if the file starts with the JPEG SOI marker"""
+    try:
+        with open(filename, "rb") as f_in:
+            return f_in.read(2) == b"\xff\xd8"
+    except OSError:
+        # reported by imread
+        return False
+
+
+def _exif_orientation(exif):
+    """Orientation tag of an EXIF (TIFF) block, 1 if missing"""
+    if len(exif) < 8 or exif[:2] not in (b"II", b"MM"):
+        return 1
+    order = "<" if exif[:2] == b"II" else ">"
+    ifd = struct.unpack(order + "I", exif[4:8])[0]
+    if ifd + 2 > len(exif):
+        return 1
+
+    n_entries = struct.unpack(order + "H", exif[ifd:ifd + 2])[0]
+    for i in range(n_entries):
+        entry = exif[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if len(entry) < 12:
+            break
+        tag = struct.unpack(order + "H", entry[:2])[0]
+        if tag == 0x0112:
+            return struct.unpack(order + "H", entry[8:10])[0]
+    return 1
+
+
+def _jpeg_info(f_in):
+    """Size and orientation from the JPEG markers before the image data
+
+    None if the markers end before the frame header or are truncated.
+    """
+    orientation = 1
+    while True:
+        byte = f_in.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f_in.read(1)
+        while marker == b"\xff":
+            marker = f_in.read(1)
+        if not marker:
+            return None
+        marker = ord(marker)
+
+        # markers without segment
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image or start of scan before any frame header
+            return None
+
+        # truncated or corrupt file, left to the full decode
+        length = f_in.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack(">H", length)[0] - 2
+        if length < 0:
+            return None
+        segment = f_in.read(length)
+        if len(segment) < length:
+            return None
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            orientation = _exif_orientation(segment[6:])
+        elif marker in _SOF_MARKERS:
+            if len(segment) < 5:
+                return None
+            height, width = struct.unpack(">HH", segment[1:5])
+            return width, height, orientation
+
+
+def read_image_info(filename):
+    """Size and EXIF orientation of an image from its header
+
+    JPEG and PNG headers are parsed without decoding, other formats are
+    decoded.
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+
+    Returns
+    -------
+    info : dict
+        "width" and "height" of the image as loaded by cv2.imread (the
+        EXIF rotation applied) and the EXIF "orientation" (1 = none)
+    """
+    info = None
+    with open(filename, "rb") as f_in:
+        header = f_in.read(24)
+        if header[:2] == b"\xff\xd8":
+            f_in.seek(2)
+            info = _jpeg_info(f_in)
+        elif header[:8] == b"\x89PNG\r\n\x1a\n" and header[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", header[16:24])
+            info = width, height, 1
+
+    if info is None:
+        image = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise IOError("Unable to read image (%s)" % filename)
+        return {"width": image.shape[1], "height": image.shape[0],
+            "orientation": 1}
+
+    width, height, orientation = info
+    if orientation in (5, 6, 7, 8):
+        # imread rotates by 90 degrees
+        width, height = height, width
+    return {"width": width, "height": height, "orientation": orientation}
+
+
+def choose_down(info, out_size):
+    """Largest number of pyramid levels keeping at least out_size
+
+    Parameters
+    ----------
+    info : dict
+        The output of read_image_info
+
+    out_size : tuple
+        Minimum (height, width) of the loaded image
+
+    Returns
+    -------
+    down : int
+        Number of pyramid levels
+    """
+    down = 0
+    height, width = info["height"], info["width"]
+    while (height + 1) // 2 >= out_size[0] and (width + 1) // 2 >= out_size[1]:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        down += 1
+    return down
+
+
+def prefetch(filenames, down=0, reduced=True, workers=2, depth=None):
+    """Load images ahead of their use on a thread pool
+
+    Parameters
+    ----------
+    filenames : list
+        The image files, in order of use
+
+    down, reduced :
+        See load_image
+
+    workers : int
+        Number of loading threads
+
+    depth : int or None
+        Maximum number of images loaded ahead, None uses 2 * workers
+
+    Yields
+    ------
+    filename : str
+        The image file
+
+    image : np.ndarray or Exception
+        The image, or the error raised while loading it
+    """
+    def load(filename):
+        try:
+            return load_image(filename, down, reduced)
+        except Exception as err:
+            return err
+
+    depth = depth or 2 * workers
+    pending = deque()
+    files = iter(filenames)
+    with ThreadPoolExecutor(workers) as pool:
+        for filename in files:
+            pending.append((filename, pool.submit(load, filename)))
+            if len(pending) >= depth:
+                break
+
+        while pending:
+            filename, future = pending.popleft()
+            # keep depth images in flight
+            for next_file in files:
+                pending.append((next_file, pool.submit(load, next_file)))
+                break
+            yield filename, future.result()
@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+"""Streaming pipelines over frame generators
+
+A pipeline is a source generating frames, a chain of stages each taking
+an iterator of frames and generating frames, and a sink consuming them.
+Frames are dicts::
+
+    {"image": np.ndarray, "detections": list or None,
+     "mask": np.ndarray or None, "source": str, "name": str, "index": int}
+
+The frames stream lazily through the chain, so several steps run in one
+pass over a video (decoded once).  run_pipeline runs every step on its
+own thread connected by bounded queues (OpenCV releases the GIL), which
+bounds the number of frames in flight.
+
+Usage::
+
+    from functools import partial
+    run_pipeline(video_source("in.mp4"),
+        [partial(detect, detector=FaceDetectCascade()),
+         partial(cartoonify, smoothing="pyramid"), annotate],
+        partial(video_sink, out="/tmp/out.avi"))
+"""
+import cv2
+import mimetypes
+import numpy as np
+import os
+import queue
+import threading
+import time
+from py_imagelab.util import get_file_type
+from py_imagelab.video_io import open_writer
+
+
+def _frame(image, source, name, index):
+    return {"image": image, "detections": None, "mask": None,
+        "source": source, "name": name, "index": index}
+
+
+# -------------------------------  sources  ---------------------------------
+def image_source(filename):
+    """Generate the frame of an image file
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+    """
+    image = cv2.imread(filename)
+    if image is None:
+        raise IOError("Unable to read image (%s)" % filename)
+    yield _frame(image, filename, os.path.basename(filename), 0)
+
+
+def directory_source(dirname):
+    """Generate the frames of the image files of a directory
+
+    The files are read in sorted order, the other files are skipped.
+
+    Parameters
+    ----------
+    dirname : str
+        The input directory
+    """
+    index = 0
+    for c_file in sorted(os.listdir(dirname)):
+        tmp_file = os.path.join(dirname, c_file)
+        if not os.path.isfile(tmp_file) or \
+                get_file_type(tmp_file) != "image":
+            continue
+
+        image = cv2.imread(tmp_file)
+        if image is None:
+            print("File (%s) unreadable...skipping" % tmp_file)
+            continue
+        yield _frame(image, tmp_file, c_file, index)
+        index += 1
+
+
+def video_source(cap=0, start_frame=0, max_frames=None):
+    """Generate the frames of a video file or capture device
+
+    Parameters
+    ----------
+    cap : int or str
+        The capture device or the video file
+
+    start_frame : int
+        Index of the first frame
+
+    max_frames : int or None
+        Maximum number of frames
+    """
+    if isinstance(cap, str):
+        assert os.path.isfile(cap), "Cap is not a valid file"
+    vc = cv2.VideoCapture(cap)
+    if not vc.isOpened():
+        raise IOError("Unable to open video capture")
+
+    if start_frame > 0 and not vc.set(cv2.CAP_PROP_POS_FRAMES, start_frame):
+        # not seekable (live device), skip frames instead
+        for _ in range(start_frame):
+            vc.grab()
+
+    try:
+        index = 0
+        while max_frames is None or index < max_frames:
+            ret, image = vc.read()
+            if not ret:
+                break
+            yield _frame(image, str(cap), "%06d.png" % index, index)
+            index += 1
+    finally:
+        vc.release()
+
+
+def open_source(in_file=""):
+    """Source of run_process inputs
+
+    Parameters
+    ----------
+    in_file : str
+        Image file, video file, directory of images or "" (webcam)
+    """
+    if not in_file:
+        return video_source(0)
+    if os.path.isdir(in_file):
+        return directory_source(in_file)
+
+    mode = get_file_type(in_file)
+    if mode == "image":
+        return image_source(in_file)
+    elif mode == "video":
+        return video_source(in_file)
+    raise IOError("Unsupported input (%s)" % in_file)
+
+
+# --------------------------------  stages  ---------------------------------
+def downsample(frames, down=1):
+    """Downsample the frames with down pyrDown (run_process convention)"""
+    for frame in frames:
+        for _ in range(down):
+            frame["image"] = cv2.pyrDown(frame["image"])
+        yield frame
+
+
+def apply(frames, process, params=None):
+    """Apply a process of run_process to the frames
+
+    The image is replaced by the processed image.  The detections are
+    replaced if the process returns any, so the detections of an
+    earlier stage are kept through the image processes.
+
+    Parameters
+    ----------
+    frames : iterator
+        The input frames
+
+    process : func
+        (processed, detections) = process(image, **params)
+
+    params : dict or None
+        Keyword arguments of the process
+    """
+    params = params or {}
+    for frame in frames:
+        image, detections = process(frame["image"], **params)
+        frame["image"] = image
+        if detections is not None:
+            frame["detections"] = detections
+        yield frame
+
+
+def detect(frames, detector=None, **params):
+    """Detect faces, FaceDetectCascade by default
+
+    Parameters
+    ----------
+    detector : object or func or None
+        An object with a detect_face method, or a process returning the
+        detections (i.e. FaceTracker(...).detect_face on video)
+    """
+    if detector is None:
+        from py_imagelab.segmentation.face_detection import \
+            FaceDetectCascade
+        detector = FaceDetectCascade()
+    process = getattr(detector, "detect_face", detector)
+    return apply(frames, process, params)
+
+
+def cartoonify(frames, regions=None, **params):
+    """Cartoonify the frames, see cartoonify_process for the parameters
+
+    Parameters
+    ----------
+    regions : str or None
+        "detections" or "mask" only cartoonifies the detections or the
+        foreground mask of the frames (see cartoonify_regions)
+    """
+    from py_imagelab.cartoon.cartoon import cartoonify_process
+    if regions is None:
+        return apply(frames, cartoonify_process, params)
+
+    assert regions in ("detections", "mask"), "Unknown regions %s" % regions
+    return _cartoonify_regions(frames, regions, params)
+
+
+def _cartoonify_regions(frames, regions, params):
+    from py_imagelab.cartoon.cartoon import cartoonify_regions
+    for frame in frames:
+        if regions == "mask":
+            frame["image"], _ = cartoonify_regions(frame["image"],
+                mask=frame["mask"], **params)
+        else:
+            frame["image"], _ = cartoonify_regions(frame["image"],
+                boxes=frame["detections"], **params)
+        yield frame
+
+
+def foreground(frames, extractor=None, **params):
+    """Extract the foreground, with a new Foreground by default
+
+    Parameters
+    ----------
+    extractor : Foreground or None
+        The extractor, keeps its state across the frames (i.e. temporal
+        or background subtraction engines).  With the "mask" output,
+        the mask goes to frame["mask"] and the image is kept.
+    """
+    if extractor is None:
+        from py_imagelab.segmentation.foreground_extraction import \
+            Foreground
+        extractor = Foreground()
+    if extractor.output != "mask":
+        return apply(frames, extractor.extract_foreground, params)
+    return _foreground_mask(frames, extractor, params)
+
+
+def _foreground_mask(frames, extractor, params):
+    for frame in frames:
+        mask, _ = extractor.extract_foreground(frame["image"], **params)
+        # the extractor reuses its mask buffer
+        frame["mask"] = mask.copy()
+        yield frame
+
+
+def annotate(frames, color=(200, 0, 0), thickness=None):
+    """Draw the detections on the images
+
+    Parameters
+    ----------
+    color : tuple
+        BGR color of the boxes
+
+    thickness : int or None
+        Line thickness, None scales with the box size (as run_process)
+    """
+    for frame in frames:
+        detections = frame["detections"]
+        if detections is None:
+            detections = []
+        for (x, y, w, h) in detections:
+            c_thickness = thickness
+            if c_thickness is None:
+                c_thickness = int(1 + np.log10(max(1, min(w, h))))
+            frame["image"] = cv2.rectangle(frame["image"], (x, y),
+                (x + w, y + h), color=color, thickness=c_thickness)
+        yield frame
+
+
+def buffered(frames, size=4, stop=None, threads=None):
+    """Run the upstream of a generator chain on a thread
+
+    At most `size` frames wait between the thread and the consumer, so
+    the upstream steps run ahead of the downstream ones with bounded
+    memory.  Exceptions of the upstream are raised to the consumer.
+
+    Parameters
+    ----------
+    frames : iterator
+        The upstream frames
+
+    size : int
+        Maximum number of frames waiting
+
+    stop : threading.Event or None
+        Event shared by the buffers of a chain, setting it stops all
+        their threads (i.e. after an error in one of the steps)
+
+    threads : list or None
+        If provided, the thread is appended to it when started, so the
+        owner of the chain can join the threads of buffers orphaned by
+        an error (see run_pipeline)
+    """
+    frames_queue = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    end = object()
+
+    def halted():
+        return stopped.is_set() or (stop is not None and stop.is_set())
+
+    def put(item):
+        while not halted():
+            try:
+                frames_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    break
+        except Exception as err:
+            put(err)
+        finally:
+            # release the upstream (threads, captures) on early exit
+            if hasattr(frames, "close"):
+                frames.close()
+            put(end)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    if threads is not None:
+        threads.append(thread)
+    try:
+        while True:
+            try:
+                item = frames_queue.get(timeout=0.1)
+            except queue.Empty:
+                if halted():
+                    break
+                continue
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # consumer done (or closed early), release the thread
+        stopped.set()
+        thread.join()
+
+
+# --------------------------------  sinks  ----------------------------------
+def null_sink(frames):
+    """Consume the frames, returns the number of frames"""
+    n_frames = 0
+    for _ in frames:
+        n_frames += 1
+    return n_frames
+
+
+def image_sink(frames, out_dir, overwrite=False, name=None):
+    """Write the frames as image files named after the frame
+
+    Parameters
+    ----------
+    out_dir : str
+        The output directory
+
+    name : str or None
+        File name of every frame instead of the frame name (single
+        image output)
+
+    overwrite : bool
+        Allow overwrite if true, existing files are skipped otherwise
+
+    Returns
+    -------
+    n_frames : int
+        The number of frames consumed
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    n_frames = 0
+    for frame in frames:
+        n_frames += 1
+        out_file = os.path.join(out_dir, name or frame["name"])
+        if os.path.isfile(out_file) and not overwrite:
+            print("File (%s) exist...skipping" % out_file)
+            continue
+        if not cv2.imwrite(out_file, frame["image"]):
+            raise IOError("Unable to write (%s)" % out_file)
+    return n_frames
+
+
+def video_sink(frames, out, fps=30., fourcc=None):
+    """Write the frames to a video file or image sequence
+
+    The frames are encoded on background threads and the output is
+    sized from the first frame (see open_writer).
+
+    Parameters
+    ----------
+    out : str
+        The output video file or image sequence pattern
+
+    fps : float
+        Frame rate of the output
+
+    fourcc : str or None
+        Codec, None selects it from the extension
+
+    Returns
+    -------
+    n_frames : int
+        The number of frames written
+    """
+    writer = open_writer(out, fps, fourcc)
+    n_frames = 0
+    try:
+        for frame in frames:
+            writer.write(frame["image"])
+            n_frames += 1
+    finally:
+        writer.close()
+    return n_frames
+
+
+def run_pipeline(source, stages=(), sink=null_sink, buffer_size=4,
+        join_timeout=10.):
+    """Stream the frames of a source through the stages into a sink
+
+    Parameters
+    ----------
+    source : iterator
+        The frames, i.e. video_source(...)
+
+    stages : list
+        Functions taking an iterator of frames and generating frames,
+        applied in order (functools.partial binds their parameters)
+
+    sink : func
+        Function consuming an iterator of frames
+
+    buffer_size : int
+        If > 0, the source and every stage run on their own thread with
+        at most this many frames waiting for the next step (buffered).
+        0 runs the whole chain on the calling thread.
+
+    join_timeout : float
+        Seconds to wait for each thread to stop when the pipeline ends,
+        i.e. a source thread in the middle of a blocking read after an
+        error downstream
+
+    Returns
+    -------
+    summary : dict
+        "frames" returned by the sink, wall "time" in seconds and "fps"
+    """
+    stop = threading.Event()
+    buffers = []
+    threads = []
+    frames = source
+    for stage in [None] + list(stages):
+        if stage is not None:
+            frames = stage(frames)
+        if buffer_size > 0:
+            frames = buffered(frames, buffer_size, stop, threads)
+            buffers.append(frames)
+
+    t_start = time.perf_counter()
+    try:
+        n_frames = sink(frames)
+    finally:
+        # stop the threads of all the steps, also on errors
+        stop.set()
+        if hasattr(frames, "close"):
+            frames.close()
+
+        # the buffers upstream of a failed stage are no longer consumed,
+        # close them and wait for their threads before returning
+        for buf in reversed(buffers):
+            try:
+                buf.close()
+            except ValueError:
+                # running on the thread of the next buffer, which stops
+                pass
+        for thread in threads:
+            thread.join(join_timeout)
+    elapsed = time.perf_counter() - t_start
+    return {
+        "frames": n_frames,
+        "time": elapsed,
+        "fps": n_frames / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+STAGES = {
+    "detect": detect,
+    "cartoonify": cartoonify,
+    "foreground": foreground,
+    "annotate": annotate,
+}
+
+
+if __name__ == "__main__":
+    from functools import partial
+    from py_imagelab.util import get_parser
+    parser = get_parser()
+    parser.set_defaults(output="")
+    parser.add_argument("--stages", default="detect,cartoonify,annotate",
+        help="Comma separated stages from %s" % ", ".join(STAGES))
+    parser.add_argument("--buffer", default=4, type=int,
+        help="Frames buffered between the steps (0 = single thread)")
+    parser.add_argument("--regions", default="",
+        choices=["", "detections", "mask"],
+        help="Only cartoonify the detections or the foreground mask")
+    args = parser.parse_args()
+
+    stages = [partial(downsample, down=args.down)]
+    for name in args.stages.split(","):
+        assert name in STAGES, "Unknown stage %s" % name
+        stage = STAGES[name]
+        if name == "cartoonify" and args.regions:
+            stage = partial(cartoonify, regions=args.regions)
+        elif name == "foreground" and args.regions == "mask":
+            from py_imagelab.segmentation.foreground_extraction import \
+                Foreground
+            stage = partial(foreground, extractor=Foreground(output="mask"))
+        stages.append(stage)
+
+    # -----------  sink from the output: none, video, image or dir  ---------
+    guess, _ = mimetypes.guess_type(args.output)
+    if not args.output:
+        sink = null_sink
+    elif "%" in args.output or (guess is not None and "video" in guess):
+        sink = partial(video_sink, out=args.output, fourcc=args.fourcc)
+    elif guess is not None and "image" in guess:
+        sink = partial(image_sink,
+            out_dir=os.path.dirname(os.path.abspath(args.output)),
+            overwrite=args.overwrite, name=os.path.basename(args.output))
+    else:
+        sink = partial(image_sink, out_dir=args.output,
+            overwrite=args.overwrite)
+
+    summary = run_pipeline(open_source(args.input), stages, sink,
+        args.buffer)
+    print("Processed %d frames in %.2f s (%.1f fps)" % (
+        summary["frames"], summary["time"], summary["fps"]))
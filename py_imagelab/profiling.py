@@ -0,0 +1,94 @@
+"""Opt-in per-stage timing of the processing functions
+
+A StageTimer is passed to a process as the ``timer`` keyword argument.
+The process calls ``timer.lap(name, output)`` after each of its stages,
+which records the wall time since the previous lap and the shape of the
+stage output.  Processes only touch the timer when one is given, so
+there is no cost when profiling is disabled.
+
+Usage::
+
+    timer = StageTimer()
+    cartoon, _ = cartoonify_process(image, timer=timer)
+    print(timer.records)
+"""
+import json
+import time
+
+
+class StageTimer():
+    """Record the wall time and output shape of each stage of a process
+    """
+    def __init__(self):
+        self.records = []
+        self._last = time.perf_counter()
+
+    def start(self):
+        """Restart the clock, called by the process before its first stage
+        """
+        self._last = time.perf_counter()
+
+    def lap(self, stage, output=None):
+        """Record a stage ending now
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage
+
+        output : np.ndarray or None
+            The output of the stage, its shape is recorded
+        """
+        now = time.perf_counter()
+        shape = getattr(output, "shape", None)
+        self.records.append({
+            "stage": stage,
+            "time": now - self._last,
+            "shape": list(shape) if shape is not None else None,
+        })
+        self._last = now
+
+    @property
+    def total(self):
+        """Sum of the recorded stage times"""
+        return sum(r["time"] for r in self.records)
+
+
+class ProfileWriter():
+    """Write per-frame stage records as JSON lines
+
+    Parameters
+    ----------
+    filename : str
+        The output JSONL file
+    """
+    def __init__(self, filename):
+        self.f_out = open(filename, "w")
+        self.n_frames = 0
+
+    def write(self, records, **extra):
+        """Write the records of one frame
+
+        Parameters
+        ----------
+        records : list
+            StageTimer.records of the frame
+
+        extra : dict
+            Additional fields of the line (i.e. source file)
+        """
+        line = {"frame": self.n_frames}
+        line.update(extra)
+        line["total"] = sum(r["time"] for r in records)
+        line["stages"] = records
+        self.f_out.write(json.dumps(line) + "\n")
+        self.n_frames += 1
+
+    def close(self):
+        self.f_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,250 @@
+"""Helpers shared by the face detectors and trackers
+
+Boxes are (x, y, w, h) in pixels, as returned by the detectors.
+"""
+import cv2
+import numpy as np
+from py_imagelab.workspace import get_buffer
+
+
+def box_iou(box_a, box_b):
+    """Intersection over union of two boxes
+
+    Parameters
+    ----------
+    box_a, box_b : sequence
+        (x, y, w, h) boxes
+
+    Returns
+    -------
+    iou : float
+        The intersection over union in [0, 1]
+    """
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    iw = min(ax + aw, bx + bw) - max(ax, bx)
+    ih = min(ay + ah, by + bh) - max(ay, by)
+    if iw <= 0 or ih <= 0:
+        return 0.0
+
+    inter = iw * ih
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+def expand_box(box, margin, shape):
+    """Expand a box by a fraction of its size and clip it to the image
+
+    Parameters
+    ----------
+    box : sequence
+        (x, y, w, h) box
+
+    margin : float
+        Fraction of the width/height added on each side
+
+    shape : tuple
+        Shape of the image
+
+    Returns
+    -------
+    box : list
+        The expanded [x, y, w, h] box
+    """
+    x, y, w, h = [int(v) for v in box]
+    dx, dy = int(margin * w), int(margin * h)
+    x0, y0 = max(0, x - dx), max(0, y - dy)
+    x1, y1 = min(shape[1], x + w + dx), min(shape[0], y + h + dy)
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def non_max_suppression(boxes, scores, max_iou=0.3):
+    """Greedy non maximum suppression
+
+    Parameters
+    ----------
+    boxes : list
+        (x, y, w, h) boxes
+
+    scores : list
+        Score of each box, higher is better
+
+    max_iou : float
+        Boxes overlapping a better box by more than this are removed
+
+    Returns
+    -------
+    keep : list
+        Indices of the kept boxes, best score first
+    """
+    keep = []
+    for i in np.argsort(scores)[::-1]:
+        if all(box_iou(boxes[i], boxes[j]) <= max_iou for j in keep):
+            keep.append(int(i))
+    return keep
+
+
+def resize_for_detection(im_gray, max_pixels=None, workspace=None):
+    """Downscale an image to at most max_pixels for detection
+
+    Parameters
+    ----------
+    im_gray : np.ndarray
+        The (gray) image
+
+    max_pixels : int or None
+        Maximum number of pixels of the working image.  None keeps the
+        image as is.
+
+    workspace : Workspace or None
+        If provided, the working image is written to its buffer
+
+    Returns
+    -------
+    im_small : np.ndarray
+        The working image
+
+    scale : float
+        Scale of the working image (<= 1), boxes found in the working
+        image are divided by it (see scale_boxes)
+    """
+    n_pixels = im_gray.shape[0] * im_gray.shape[1]
+    if max_pixels is None or n_pixels <= max_pixels:
+        return im_gray, 1.0
+
+    scale = np.sqrt(max_pixels / float(n_pixels))
+    dsize = (int(round(im_gray.shape[1] * scale)),
+        int(round(im_gray.shape[0] * scale)))
+    im_small = cv2.resize(im_gray, dsize,
+        dst=get_buffer(workspace, "detect_small", (dsize[1], dsize[0])),
+        interpolation=cv2.INTER_AREA)
+    return im_small, scale
+
+
+def scale_boxes(boxes, scale):
+    """Scale (x, y, w, h) boxes
+
+    Parameters
+    ----------
+    boxes : sequence
+        (x, y, w, h) boxes
+
+    scale : float
+        The scale factor
+
+    Returns
+    -------
+    boxes : list
+        The scaled [x, y, w, h] boxes
+    """
+    return [[int(round(v * scale)) for v in box] for box in boxes]
+
+
+def merge_boxes(boxes):
+    """Merge overlapping boxes into their bounding boxes
+
+    Parameters
+    ----------
+    boxes : list
+        (x, y, w, h) boxes
+
+    Returns
+    -------
+    merged : list
+        Non overlapping [x, y, w, h] boxes covering the input boxes
+    """
+    merged = [list(b) for b in boxes]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                if box_iou(merged[i], merged[j]) > 0:
+                    ax, ay, aw, ah = merged[i]
+                    bx, by, bw, bh = merged.pop(j)
+                    x0, y0 = min(ax, bx), min(ay, by)
+                    x1 = max(ax + aw, bx + bw)
+                    y1 = max(ay + ah, by + bh)
+                    merged[i] = [x0, y0, x1 - x0, y1 - y0]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+class DetectionState():
+    """State of an incremental face detection over video frames
+
+    Passed to the detect_face method of the detectors (i.e. through the
+    params of run_process/test_webcam).  When faces were found in the
+    previous frame, the detector only searches windows around them with
+    scale limits derived from their sizes.  A full frame sweep runs
+    every full_every frames (and whenever nothing was found) to pick up
+    new faces.  The detector updates the state in place, the last
+    detections are in self.faces.
+
+    Parameters
+    ----------
+    full_every : int
+        Run a full frame detection every this many frames
+
+    margin : float
+        Fraction of the box size added on each side of the previous
+        boxes to build the search windows
+
+    scale_margin : float
+        Relative change of the face size allowed between frames
+    """
+    def __init__(self, full_every=10, margin=0.5, scale_margin=0.3):
+        self.full_every = full_every
+        self.margin = margin
+        self.scale_margin = scale_margin
+        self.faces = []
+        self.frame_index = 0
+
+    def needs_full(self):
+        """True if the next detection should scan the full frame"""
+        return len(self.faces) == 0 or \
+            self.frame_index % self.full_every == 0
+
+    def windows(self, shape, scale=1.0):
+        """Search windows around the previous detections
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the (working) image
+
+        scale : float
+            Scale of the working image relative to the detections
+
+        Returns
+        -------
+        windows : list
+            Non overlapping [x, y, w, h] windows
+        """
+        return merge_boxes([expand_box(f, self.margin, shape)
+            for f in scale_boxes(self.faces, scale)])
+
+    def size_limits(self, scale=1.0):
+        """Minimum and maximum face size from the previous detections
+
+        Parameters
+        ----------
+        scale : float
+            Scale of the working image relative to the detections
+
+        Returns
+        -------
+        min_size, max_size : int
+            Face width limits in pixels
+        """
+        widths = [f[2] * scale for f in self.faces]
+        min_size = int(min(widths) * (1 - self.scale_margin))
+        max_size = int(max(widths) * (1 + self.scale_margin)) + 1
+        return max(1, min_size), max_size
+
+    def update(self, faces):
+        """Store the detections of the current frame"""
+        self.faces = [[int(v) for v in f] for f in faces]
+        self.frame_index += 1
@@ -5,43 +5,138 @@ References
 .. [1] https://docs.opencv.org/3.4/db/d28/tutorial_cascade_classifier.html
 """
 import cv2
-from py_imagelab.util import run_process, get_parser
+from py_imagelab.util import run_process, get_parser, process_options
+from py_imagelab.segmentation.face_tracking import FaceTracker
+from py_imagelab.segmentation.detection_util import DetectionState
+from py_imagelab.segmentation.detection_util import resize_for_detection
+from py_imagelab.segmentation.detection_util import scale_boxes
+from py_imagelab.workspace import get_buffer
 
 
 class FaceDetectCascade():
     """Face Detection using the Haar Cascade model
+
+    Parameters
+    ----------
+    max_pixels : int or None
+        If provided, detection runs on a copy downscaled to at most this
+        many pixels and the boxes are mapped back to the input
+        resolution, so the cost stays flat for large inputs.
+
+    min_neighbors : int
+        detectMultiScale minNeighbors, lower values find more (and
+        noisier) candidates
     """
-    def __init__(self):
+    def __init__(self, max_pixels=None, min_neighbors=3):
+        self.max_pixels = max_pixels
+        self.min_neighbors = min_neighbors
         self.face_cascade = cv2.CascadeClassifier()
 
         # load face model from cv2 installation folder
         dir_data = cv2.__path__[0] + '/data/'
         self.face_cascade.load(dir_data + 'haarcascade_frontalface_default.xml')
 
-    def detect_face(self, im):
+    def __getstate__(self):
+        # the cascade classifier can not be pickled, reload it instead
+        return {"max_pixels": self.max_pixels,
+            "min_neighbors": self.min_neighbors}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_pixels"], state["min_neighbors"])
+
+    def _detect_windows(self, im_gray, state, scale=1.0):
+        """Detect faces only in the search windows of the state"""
+        min_size, max_size = state.size_limits(scale)
+        faces = []
+        for (x, y, w, h) in state.windows(im_gray.shape, scale):
+            rois = self.face_cascade.detectMultiScale(
+                im_gray[y:y + h, x:x + w], minNeighbors=self.min_neighbors,
+                minSize=(min_size, min_size), maxSize=(max_size, max_size))
+            for (fx, fy, fw, fh) in rois:
+                faces.append([int(fx) + x, int(fy) + y, int(fw), int(fh)])
+        return faces
+
+    def detect_face(self, im, timer=None, state=None, workspace=None):
+        """Detect faces in the image
+
+        Parameters
+        ----------
+        im : np.ndarray or str
+            The BGR image or path to the image
 
+        timer : StageTimer or None
+            If provided, records the time of each stage
+
+        state : DetectionState or None
+            If provided, only search around the faces of the previous
+            frame (within the face size limits), except on the periodic
+            full frame sweeps.  The state is updated in place.
+
+        workspace : Workspace or None
+            If provided, the gray and equalized images are written to
+            its buffers
+
+        Returns
+        -------
+        im : np.ndarray
+            The input image
+
+        faces : list
+            Detected (x, y, w, h) boxes
+        """
         if isinstance(im, str):
             im = cv2.imread(im)
-        im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-        im_gray = cv2.equalizeHist(im_gray)
+        if timer is not None:
+            timer.start()
+        im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY,
+            dst=get_buffer(workspace, "gray", im.shape[:2]))
+        im_gray, scale = resize_for_detection(im_gray, self.max_pixels,
+            workspace)
+        if timer is not None:
+            timer.lap("gray", im_gray)
+        im_gray = cv2.equalizeHist(im_gray,
+            dst=get_buffer(workspace, "equalized", im_gray.shape))
+        if timer is not None:
+            timer.lap("equalize", im_gray)
+
+        if state is not None and not state.needs_full():
+            faces = self._detect_windows(im_gray, state, scale)
+        else:
+            faces = self.face_cascade.detectMultiScale(im_gray,
+                minNeighbors=self.min_neighbors)
+
+        if scale != 1.0:
+            # back to input resolution
+            faces = scale_boxes(faces, 1 / scale)
 
-        faces = self.face_cascade.detectMultiScale(im_gray)
+        if state is not None:
+            state.update(faces)
+        if timer is not None:
+            timer.lap("detect", faces)
         return im, faces
 
 
 if __name__ == "__main__":
     parser = get_parser()
+    parser.add_argument("--track", default=0, type=int,
+        help="Detect every N frames and track faces in between (video)")
+    parser.add_argument("--incremental", default=0, type=int,
+        help="Search around previous faces, full frame every N frames")
+    parser.add_argument("--max_pixels", default=0, type=int,
+        help="Detect on a copy downscaled to at most this many pixels")
     args = parser.parse_args()
 
-    fdo = FaceDetectCascade()
+    fdo = FaceDetectCascade(args.max_pixels or None)
+    process = fdo.detect_face
+    if args.track > 0:
+        process = FaceTracker(fdo.detect_face, args.track).detect_face
 
+    params = {}
+    if args.incremental > 0:
+        params["state"] = DetectionState(full_every=args.incremental)
 
     run_process(
-        process=fdo.detect_face,
-        params={},
+        process=process,
+        params=params,
         title="Face Detection",
-        in_file=args.input,
-        out_file=args.output,
-        down=args.down,
-        overwrite=args.overwrite,
-    )
+        **process_options(args))
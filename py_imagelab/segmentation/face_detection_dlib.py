@@ -8,13 +8,36 @@ References
     https://towardsdatascience.com/cnn-based-face-detector-from-dlib-c3696195e01c
 """
 import cv2
+import json
 import os
 import dlib
-from py_imagelab.util import run_process, get_parser
+from py_imagelab.util import run_process, get_parser, process_options
+from py_imagelab.segmentation.face_tracking import FaceTracker
+from py_imagelab.segmentation.detection_util import DetectionState
+from py_imagelab.segmentation.detection_util import resize_for_detection
+from py_imagelab.segmentation.detection_util import scale_boxes
+from py_imagelab.workspace import get_buffer
+
+# smallest face (pixels) found by the HOG and CNN detectors without upsample
+DLIB_MIN_FACE = 80
 
 
 class FaceDetectDlib():
-    def __init__(self, model=None):
+    """Face detection with the dlib HOG or CNN detector
+
+    Parameters
+    ----------
+    model : str or None
+        Path to a cnn_face_detection_model_v1 model, None uses HOG
+
+    max_pixels : int or None
+        If provided, detection runs on a copy downscaled to at most this
+        many pixels and the boxes are mapped back to the input
+        resolution, so the cost stays flat for large inputs.
+    """
+    def __init__(self, model=None, max_pixels=None):
+        self.model = model
+        self.max_pixels = max_pixels
         if model is not None and model != "":
             assert os.path.isfile(model), "Model file does not exist"
             self.detector = dlib.cnn_face_detection_model_v1(model)
@@ -23,35 +46,256 @@ class FaceDetectDlib():
             self.detector = dlib.get_frontal_face_detector()
         self.upsample = 1
 
-    def detect_face(self, im):
+    def __getstate__(self):
+        # dlib detectors are reloaded from the model file when unpickled
+        return {"model": self.model, "max_pixels": self.max_pixels,
+            "upsample": self.upsample}
+
+    def __setstate__(self, state):
+        self.__init__(state["model"], state["max_pixels"])
+        self.upsample = state["upsample"]
+
+    @staticmethod
+    def _to_faces(rects):
+        """Convert dlib rectangles to [x, y, w, h] boxes"""
+        faces = []
+        for r in rects:
+            # the CNN detector returns mmod_rectangles
+            r = getattr(r, "rect", r)
+            faces.append([r.left(), r.top(), r.width(), r.height()])
+        return faces
+
+    def _detect(self, im_gray, upsample):
+        """Run the detector, return [x, y, w, h] boxes"""
+        return self._to_faces(self.detector(im_gray, upsample))
+
+    def _detect_windows(self, im_gray, state, scale=1.0):
+        """Detect faces only in the search windows of the state
+
+        The windows are downscaled (and the upsample dropped) when the
+        previous faces are larger than what the detector needs.
+        """
+        min_size, max_size = state.size_limits(scale)
+        roi_scale = min(1.0, DLIB_MIN_FACE / float(min_size))
+        upsample = 0 if min_size >= DLIB_MIN_FACE else self.upsample
+
+        faces = []
+        for (x, y, w, h) in state.windows(im_gray.shape, scale):
+            roi = im_gray[y:y + h, x:x + w]
+            if roi_scale < 1.0:
+                roi = cv2.resize(roi, None, fx=roi_scale, fy=roi_scale,
+                    interpolation=cv2.INTER_AREA)
+
+            for (fx, fy, fw, fh) in self._detect(roi, upsample):
+                fw, fh = int(fw / roi_scale), int(fh / roi_scale)
+                if min_size <= fw <= max_size:
+                    faces.append([x + int(fx / roi_scale),
+                        y + int(fy / roi_scale), fw, fh])
+        return faces
+
+    def detect_face(self, im, timer=None, state=None, workspace=None):
+        """Detect faces in the image
+
+        Parameters
+        ----------
+        im : np.ndarray or str
+            The BGR image or path to the image
+
+        timer : StageTimer or None
+            If provided, records the time of each stage
+
+        state : DetectionState or None
+            If provided, only search around the faces of the previous
+            frame (within the face size limits), except on the periodic
+            full frame sweeps.  The state is updated in place.
+
+        workspace : Workspace or None
+            If provided, the gray and equalized images are written to
+            its buffers
+
+        Returns
+        -------
+        im : np.ndarray
+            The input image
+
+        faces : list
+            Detected [x, y, w, h] boxes
+        """
         if isinstance(im, str):
             im = cv2.imread(im)
-        im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-        im_gray = cv2.equalizeHist(im_gray)
+        if timer is not None:
+            timer.start()
+        im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY,
+            dst=get_buffer(workspace, "gray", im.shape[:2]))
+        im_gray, scale = resize_for_detection(im_gray, self.max_pixels,
+            workspace)
+        if timer is not None:
+            timer.lap("gray", im_gray)
+        im_gray = cv2.equalizeHist(im_gray,
+            dst=get_buffer(workspace, "equalized", im_gray.shape))
+        if timer is not None:
+            timer.lap("equalize", im_gray)
 
-        rects = self.detector(im_gray, self.upsample)
-        faces = []
-        if len(rects) > 0:
-            for r in rects:
-                faces.append([r.left(), r.top(), r.width(), r.height()])
+        if state is not None and not state.needs_full():
+            faces = self._detect_windows(im_gray, state, scale)
+        else:
+            faces = self._detect(im_gray, self.upsample)
+
+        if scale != 1.0:
+            # back to input resolution
+            faces = scale_boxes(faces, 1 / scale)
+
+        if state is not None:
+            state.update(faces)
+        if timer is not None:
+            timer.lap("detect")
 
         return im, faces
 
+    def detect_faces_batch(self, frames, batch_size=None):
+        """Detect faces in a list of frames
+
+        With the CNN model, frames of the same size are sent to the
+        detector in one call, which spreads the per call overhead.  The
+        HOG detector has no batch interface and runs per frame.
+
+        Parameters
+        ----------
+        frames : list
+            BGR images
+
+        batch_size : int or None
+            CNN batch size, None sends all frames of a size at once
+
+        Returns
+        -------
+        faces_batch : list
+            Detected [x, y, w, h] boxes of each frame, in order
+        """
+        grays = []
+        scales = []
+        for im in frames:
+            im_gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+            im_gray, scale = resize_for_detection(im_gray, self.max_pixels)
+            grays.append(cv2.equalizeHist(im_gray))
+            scales.append(scale)
+
+        faces_batch = [None] * len(frames)
+        if self.model:
+            # the CNN batch needs images of the same size
+            by_shape = {}
+            for i, im_gray in enumerate(grays):
+                by_shape.setdefault(im_gray.shape, []).append(i)
+
+            for indices in by_shape.values():
+                batch = [grays[i] for i in indices]
+                rects_batch = self.detector(batch, self.upsample,
+                    batch_size=batch_size or len(batch))
+                for i, rects in zip(indices, rects_batch):
+                    faces_batch[i] = self._to_faces(rects)
+        else:
+            for i, im_gray in enumerate(grays):
+                faces_batch[i] = self._detect(im_gray, self.upsample)
+
+        for i, scale in enumerate(scales):
+            if scale != 1.0:
+                faces_batch[i] = scale_boxes(faces_batch[i], 1 / scale)
+        return faces_batch
+
+    def detect_video(self, cap, batch_size=8, down=0, start_frame=0,
+            max_frames=None):
+        """Detect faces in a video file, batch_size frames at a time
+
+        Parameters
+        ----------
+        cap : str
+            The video file
+
+        batch_size : int
+            Number of consecutive frames per detector call
+
+        down : int
+            Number of pyrDown applied to the frames
+
+        start_frame : int
+            Index of the first frame
+
+        max_frames : int or None
+            Maximum number of frames
+
+        Returns
+        -------
+        faces_video : list
+            Detected [x, y, w, h] boxes of each frame, in order
+        """
+        assert os.path.isfile(cap), "Cap is not a valid file"
+        vc = cv2.VideoCapture(cap)
+        if not vc.isOpened():
+            raise IOError("Unable to open video capture")
+        if start_frame > 0:
+            vc.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        faces_video = []
+        frames = []
+        while max_frames is None or \
+                len(faces_video) + len(frames) < max_frames:
+            ret, frame = vc.read()
+            if not ret:
+                break
+
+            for _ in range(down):
+                frame = cv2.pyrDown(frame)
+            frames.append(frame)
+
+            if len(frames) == batch_size:
+                faces_video.extend(self.detect_faces_batch(frames))
+                frames = []
+
+        if frames:
+            faces_video.extend(self.detect_faces_batch(frames))
+        vc.release()
+        return faces_video
+
 
 if __name__ == "__main__":
     parser = get_parser()
     parser.add_argument("--model", default="", help="if supplied will load model")
+    parser.add_argument("--track", default=0, type=int,
+        help="Detect every N frames and track faces in between (video)")
+    parser.add_argument("--incremental", default=0, type=int,
+        help="Search around previous faces, full frame every N frames")
+    parser.add_argument("--max_pixels", default=0, type=int,
+        help="Detect on a copy downscaled to at most this many pixels")
+    parser.add_argument("--batch", default=0, type=int,
+        help="Batch N video frames per detection, write boxes to the "
+        "--output .jsonl file")
     args = parser.parse_args()
+    if args.batch > 0:
+        if not args.output.endswith(".jsonl"):
+            parser.error("--batch writes JSONL, expecting a .jsonl --output")
+        assert args.overwrite or not os.path.isfile(args.output), \
+            "File already exist...abort"
+
+    fdo = FaceDetectDlib(args.model, args.max_pixels or None)
+    if args.batch > 0:
+        # offline batched detection of a video file, one line per frame
+        faces_video = fdo.detect_video(args.input, args.batch, args.down)
+        with open(args.output, "w") as f_out:
+            for i_frame, faces in enumerate(faces_video):
+                f_out.write(json.dumps(
+                    {"frame": i_frame, "faces": faces}) + "\n")
 
-    fdo = FaceDetectDlib(args.model)
+    else:
+        process = fdo.detect_face
+        if args.track > 0:
+            process = FaceTracker(fdo.detect_face, args.track).detect_face
 
+        params = {}
+        if args.incremental > 0:
+            params["state"] = DetectionState(full_every=args.incremental)
 
-    run_process(
-        process=fdo.detect_face,
-        params={},
-        title="Face Detection",
-        in_file=args.input,
-        out_file=args.output,
-        down=args.down,
-        overwrite=args.overwrite,
-    )
+        run_process(
+            process=process,
+            params=params,
+            title="Face Detection",
+            **process_options(args))
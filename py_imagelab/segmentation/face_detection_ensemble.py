@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Cascade gated dlib CNN face detection
+
+A cheap detector (Haar cascade or dlib HOG) proposes candidate faces
+and the accurate but slow dlib CNN detector only runs on padded crops
+around them, instead of on the full frame.  The CNN detections and the
+unconfirmed candidates are fused by non maximum suppression, the CNN
+detections ranking first.
+
+References
+----------
+.. [1] https://docs.opencv.org/3.4/db/d28/tutorial_cascade_classifier.html
+.. [2] A. Ponnnusamy, "CNN based face detector from dlib"
+    https://towardsdatascience.com/cnn-based-face-detector-from-dlib-c3696195e01c
+"""
+import cv2
+import numpy as np
+from py_imagelab.util import run_process, get_parser, process_options
+from py_imagelab.segmentation.face_detection import FaceDetectCascade
+from py_imagelab.segmentation.face_detection_dlib import FaceDetectDlib
+from py_imagelab.segmentation.face_detection_dlib import DLIB_MIN_FACE
+from py_imagelab.segmentation.detection_util import expand_box
+from py_imagelab.segmentation.detection_util import non_max_suppression
+
+
+class FaceDetectEnsemble():
+    """Verify the candidates of a fast detector with the dlib CNN
+
+    Parameters
+    ----------
+    model : str
+        Path to the dlib cnn_face_detection_model_v1 model
+
+    proposer : object or None
+        Fast detector with a detect_face(im) -> (im, faces) method.
+        Defaults to a FaceDetectCascade, with min_neighbors=1 if gate
+        (high recall, the CNN removes the false candidates), otherwise
+        the default min_neighbors (its candidates may be kept).
+
+    pad : float
+        Fraction of the candidate size added on each side of the crop
+
+    cnn_face_size : int
+        The crops are resized so the candidate is about this wide
+        (the CNN finds faces of DLIB_MIN_FACE pixels and up)
+
+    min_confidence : float
+        Minimum CNN confidence of a detection
+
+    proposal_score : float or None
+        Score of the candidates not confirmed by the CNN in the non
+        maximum suppression, so they are removed by the CNN detections
+        they overlap.  None uses just below min_confidence (the CNN
+        detections always rank first).
+
+    gate : bool
+        If true, the candidates not confirmed by the CNN are dropped
+        (higher precision, the CNN gates the proposer instead of being
+        fused with it)
+
+    max_iou : float
+        Overlap above which the non maximum suppression removes a box
+    """
+    def __init__(self, model, proposer=None, pad=0.5, cnn_face_size=100,
+            min_confidence=0.0, proposal_score=None, gate=False,
+            max_iou=0.3):
+        assert model, "Expecting the CNN model file"
+        self.cnn = FaceDetectDlib(model)
+        if proposer is None:
+            proposer = FaceDetectCascade(min_neighbors=1 if gate else 3)
+        self.proposer = proposer
+        self.pad = pad
+        self.cnn_face_size = max(cnn_face_size, DLIB_MIN_FACE)
+        self.min_confidence = min_confidence
+        if proposal_score is None:
+            proposal_score = float(np.nextafter(min_confidence, -np.inf))
+        self.proposal_score = proposal_score
+        self.gate = gate
+        self.max_iou = max_iou
+
+    def detect_face(self, im, timer=None, workspace=None):
+        """Detect faces in the image
+
+        Parameters
+        ----------
+        im : np.ndarray or str
+            The BGR image or path to the image
+
+        timer : StageTimer or None
+            If provided, records the time of each stage
+
+        workspace : Workspace or None
+            If provided, passed to the proposer
+
+        Returns
+        -------
+        im : np.ndarray
+            The input image
+
+        faces : list
+            Detected [x, y, w, h] boxes
+        """
+        if isinstance(im, str):
+            im = cv2.imread(im)
+        if timer is not None:
+            timer.start()
+
+        if workspace is not None:
+            _, proposals = self.proposer.detect_face(im, workspace=workspace)
+        else:
+            _, proposals = self.proposer.detect_face(im)
+        if timer is not None:
+            timer.lap("propose")
+
+        # ----------------  run the CNN on the candidate crops  -------------
+        boxes = []
+        scores = []
+        for proposal in proposals:
+            x, y, w, h = expand_box(proposal, self.pad, im.shape)
+            scale = self.cnn_face_size / float(max(proposal[2], 1))
+            crop = cv2.cvtColor(im[y:y + h, x:x + w], cv2.COLOR_BGR2RGB)
+            crop = cv2.resize(crop, None, fx=scale, fy=scale,
+                interpolation=cv2.INTER_AREA if scale < 1
+                else cv2.INTER_LINEAR)
+
+            confirmed = False
+            for r in self.cnn.detector(crop, 0):
+                if r.confidence < self.min_confidence:
+                    continue
+                rect = r.rect
+                boxes.append([x + int(rect.left() / scale),
+                    y + int(rect.top() / scale), int(rect.width() / scale),
+                    int(rect.height() / scale)])
+                scores.append(r.confidence)
+                confirmed = True
+
+            if not confirmed and not self.gate:
+                boxes.append([int(v) for v in proposal])
+                scores.append(self.proposal_score)
+        if timer is not None:
+            timer.lap("verify")
+
+        # overlapping crops find the same face several times, and the
+        # unconfirmed candidates overlap the CNN boxes
+        faces = [boxes[i] for i in
+            non_max_suppression(boxes, scores, self.max_iou)]
+        if timer is not None:
+            timer.lap("nms")
+        return im, faces
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument("--model", default="", help="dlib CNN model file")
+    parser.add_argument("--proposer", default="cascade",
+        choices=["cascade", "hog"], help="Detector proposing candidates")
+    parser.add_argument("--max_pixels", default=0, type=int,
+        help="Propose on a copy downscaled to at most this many pixels")
+    parser.add_argument("--gate", action="store_true",
+        help="Drop the candidates not confirmed by the CNN")
+    args = parser.parse_args()
+
+    if args.proposer == "hog":
+        proposer = FaceDetectDlib(max_pixels=args.max_pixels or None)
+    else:
+        proposer = FaceDetectCascade(args.max_pixels or None,
+            min_neighbors=1 if args.gate else 3)
+    fdo = FaceDetectEnsemble(args.model, proposer, gate=args.gate)
+
+    run_process(
+        process=fdo.detect_face,
+        params={},
+        title="Face Detection",
+        **process_options(args))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""Tracking assisted face detection for video
+
+A full frame detection runs every N frames (or when a track is lost)
+and the faces are propagated between detections by template matching
+around their previous position, which is much cheaper than a detection.
+
+References
+----------
+.. [1] https://docs.opencv.org/4.x/d4/dc6/tutorial_py_template_matching.html
+"""
+import cv2
+from py_imagelab.segmentation.detection_util import box_iou, expand_box
+from py_imagelab.workspace import get_buffer
+
+
+class FaceTracker():
+    """Propagate face detections between periodic full frame detections
+
+    Follows the process signature, so it can be used in place of the
+    detector with run_process/test_webcam.
+
+    Parameters
+    ----------
+    detector : func
+        Face detection process, (im, faces) = detector(im), i.e. the
+        detect_face method of FaceDetectCascade or FaceDetectDlib
+
+    detect_every : int
+        Run the detector every this many frames
+
+    min_score : float
+        Template matching score (normalized correlation) below which a
+        track is considered lost, the detector runs on the next frame
+
+    search : float
+        Size of the search window around the previous box, as a
+        fraction of the box size added on each side
+
+    template_size : int
+        Width the face templates are resized to for matching
+
+    match_iou : float
+        Minimum overlap to keep the ID of a track for a new detection
+
+    draw_ids : bool
+        Write the track IDs on the image
+    """
+    def __init__(self, detector, detect_every=10, min_score=0.5,
+            search=0.5, template_size=32, match_iou=0.3, draw_ids=False):
+        self.detector = detector
+        self.detect_every = detect_every
+        self.min_score = min_score
+        self.search = search
+        self.template_size = template_size
+        self.match_iou = match_iou
+        self.draw_ids = draw_ids
+
+        # list of {"id", "box", "score", "template", "scale"}
+        self.tracks = []
+        self.next_id = 0
+        self.frame_index = 0
+        self.redetect = True
+
+    def _template(self, gray, box):
+        """Resized face template and the scale used"""
+        x, y, w, h = box
+        scale = min(1.0, self.template_size / float(max(w, 1)))
+        template = gray[y:y + h, x:x + w]
+        if scale < 1.0:
+            template = cv2.resize(template, None, fx=scale, fy=scale,
+                interpolation=cv2.INTER_AREA)
+        else:
+            # the gray frame may be a reused workspace buffer
+            template = template.copy()
+        return template, scale
+
+    def _associate(self, gray, faces):
+        """Replace the tracks with the detections, keeping matching IDs"""
+        tracks = []
+        for face in faces:
+            box = [int(v) for v in face]
+            if box[2] <= 0 or box[3] <= 0:
+                continue
+
+            # keep the ID of the best overlapping previous track
+            best, best_iou = None, self.match_iou
+            for track in self.tracks:
+                iou = box_iou(box, track["box"])
+                if iou >= best_iou:
+                    best, best_iou = track, iou
+
+            if best is not None:
+                track_id = best["id"]
+                self.tracks.remove(best)
+            else:
+                track_id = self.next_id
+                self.next_id += 1
+
+            template, scale = self._template(gray, box)
+            tracks.append({"id": track_id, "box": box, "score": 1.0,
+                "template": template, "scale": scale})
+        self.tracks = tracks
+
+    def _propagate(self, gray):
+        """Move the tracks to the best template match in their window"""
+        for track in self.tracks:
+            x0, y0, w, h = expand_box(track["box"], self.search, gray.shape)
+            scale = track["scale"]
+            window = gray[y0:y0 + h, x0:x0 + w]
+            if scale < 1.0:
+                window = cv2.resize(window, None, fx=scale, fy=scale,
+                    interpolation=cv2.INTER_AREA)
+
+            template = track["template"]
+            if window.shape[0] < template.shape[0] or \
+                    window.shape[1] < template.shape[1]:
+                # face left the image
+                track["score"] = 0.0
+                continue
+
+            match = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (mx, my) = cv2.minMaxLoc(match)
+            track["score"] = score
+            track["box"] = [x0 + int(mx / scale), y0 + int(my / scale),
+                track["box"][2], track["box"][3]]
+
+        # lost tracks are kept for their IDs but trigger a detection
+        if any(t["score"] < self.min_score for t in self.tracks):
+            self.redetect = True
+
+    def detect_face(self, im, timer=None, state=None, workspace=None):
+        """Detect or track the faces in the next video frame
+
+        Parameters
+        ----------
+        im : np.ndarray
+            The BGR frame
+
+        timer : StageTimer or None
+            If provided, records the time of each stage
+
+        state : DetectionState or None
+            If provided, passed to the detector (incremental detection).
+            The detector searches around the tracked boxes and
+            full_every counts the detector runs, not the frames.
+
+        workspace : Workspace or None
+            If provided, the gray frame is written to its buffers and
+            it is passed to the detector
+
+        Returns
+        -------
+        im : np.ndarray
+            The input frame (with IDs if draw_ids)
+
+        faces : list
+            [x, y, w, h] boxes, self.tracks holds the IDs and scores
+        """
+        if timer is not None:
+            timer.start()
+        gray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY,
+            dst=get_buffer(workspace, "track_gray", im.shape[:2]))
+        if timer is not None:
+            timer.lap("gray", gray)
+
+        if self.redetect or self.frame_index % self.detect_every == 0:
+            kwargs = {}
+            if state is not None:
+                # search around where the tracks are now
+                tracked = [t["box"] for t in self.tracks
+                    if t["score"] >= self.min_score]
+                if tracked:
+                    state.faces = tracked
+                kwargs["state"] = state
+            if workspace is not None:
+                kwargs["workspace"] = workspace
+            _, faces = self.detector(im, **kwargs)
+            self._associate(gray, faces)
+            self.redetect = False
+            if timer is not None:
+                timer.lap("detect")
+
+        else:
+            self._propagate(gray)
+            if timer is not None:
+                timer.lap("track")
+        self.frame_index += 1
+
+        if self.draw_ids:
+            for track in self.tracks:
+                if track["score"] < self.min_score:
+                    continue
+                x, y = track["box"][:2]
+                cv2.putText(im, str(track["id"]), (x, max(0, y - 5)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 200, 0), 2)
+
+        return im, [t["box"] for t in self.tracks
+            if t["score"] >= self.min_score]
@@ -1,36 +1,380 @@
 import cv2
 import numpy as np
+from py_imagelab.workspace import get_buffer
+
+# minimum shortest side of the coarse image and rect of the coarse to
+# fine mode, smaller images lose the foreground
+MIN_COARSE_SIZE = 64
+MIN_COARSE_RECT = 16
+
+# keeps the models of the initialization (GC_EVAL before OpenCV 4.1)
+_GC_EVAL_FROZEN = getattr(cv2, "GC_EVAL_FREEZE_MODEL", cv2.GC_EVAL)
+
+
 class Foreground():
-    def __init__(self,):
+    """Foreground extraction with GrabCut
+
+    Parameters
+    ----------
+    temporal : bool
+        Video mode.  After the first frame, GrabCut resumes from the
+        previous mask (relabeled probable) and the GMM models of the
+        last initialization (GC_EVAL_FREEZE_MODEL) with fewer
+        iterations, a full initialization only happens on a scene
+        change.
+
+    iterations : int
+        GrabCut iterations of a full initialization
+
+    update_iterations : int
+        GrabCut iterations of the temporal updates
+
+    scene_change : float
+        Mean absolute difference (0-1) of the gray thumbnails of two
+        frames above which the temporal mode re-initializes
+
+    levels : int
+        Coarse to fine mode if > 0.  The initialization runs on the
+        image reduced by this many pyramid levels, then GrabCut only
+        refines a band of uncertain pixels around the upsampled
+        boundary at full resolution.
+
+    band : int
+        Half width (full resolution pixels) of the refined band
+
+    refine_iterations : int
+        GrabCut iterations of the full resolution refinement
+
+    engine : str
+        "grabcut", or a background subtractor for static cameras,
+        "mog2" or "knn".  The subtractors learn the background over
+        the frames, the foreground is what moves.
+
+    motion_scale : float
+        The background subtractor runs on the frame resized by this
+        factor, the cleaned mask is upsampled to the frame size
+
+    open_size : int
+        Size of the morphological opening removing the speckles of the
+        motion mask, and of the closing filling its holes
+
+    seed_grabcut : float or None
+        If provided, frames whose motion mask is ambiguous (fraction
+        of shadow and opened away pixels in the motion mask above this
+        value) are refined with GrabCut seeded by the motion mask
+
+    output : str
+        "image", the masked image, or "mask", the 0/1 uint8 foreground
+        mask.  The mask is written to a buffer reused by the next call
+        (no per-frame allocation), copy it to keep it.
+    """
+    def __init__(self, temporal=False, iterations=5, update_iterations=1,
+            scene_change=0.15, levels=0, band=8, refine_iterations=2,
+            engine="grabcut", motion_scale=0.5, open_size=5,
+            seed_grabcut=None, output="image"):
+        assert engine in ("grabcut", "mog2", "knn"), \
+            "Unknown foreground engine %s" % engine
+        assert output in ("image", "mask"), "Unknown output %s" % output
         self.mask = None
+        self.output = output
+        self.fg = None
 
         self.bg_model = np.zeros((1, 65), np.float64)
         self.fg_model = np.zeros((1, 65), np.float64)
 
-    def extract_foreground(self, img, rect=None):
+        self.temporal = temporal
+        self.iterations = iterations
+        self.update_iterations = update_iterations
+        self.scene_change = scene_change
+        self.thumb = None
+
+        self.levels = levels
+        self.band = band
+        self.refine_iterations = refine_iterations
+
+        self.engine = engine
+        self.motion_scale = motion_scale
+        self.seed_grabcut = seed_grabcut
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
+            (open_size, open_size))
+        if engine == "mog2":
+            self.subtractor = cv2.createBackgroundSubtractorMOG2()
+        elif engine == "knn":
+            self.subtractor = cv2.createBackgroundSubtractorKNN()
+        else:
+            self.subtractor = None
+
+    def _coarse_levels(self, shape, rect):
+        """Number of pyramid levels, at most levels, keeping the coarse
+        image and rect above MIN_COARSE_SIZE and MIN_COARSE_RECT"""
+        size = min(shape[:2])
+        rect_size = min(rect[2], rect[3])
+        levels = 0
+        while levels < self.levels and (size + 1) // 2 >= MIN_COARSE_SIZE \
+                and rect_size // 2 >= MIN_COARSE_RECT:
+            size, rect_size = (size + 1) // 2, rect_size // 2
+            levels += 1
+        return levels
+
+    def _coarse_mask(self, small, rect_small):
+        """GrabCut labels of the pyramid level"""
+        mask_small = np.zeros(small.shape[:2], np.uint8)
+        cv2.grabCut(small, mask_small, rect_small, self.bg_model,
+            self.fg_model, self.iterations, cv2.GC_INIT_WITH_RECT)
+        return mask_small
+
+    def _grabcut_multires(self, img, rect):
+        """Coarse to fine GrabCut initialization of self.mask
+
+        GrabCut runs on a pyramid level, the mask is upsampled and the
+        pixels further than `band` from the boundary are fixed to
+        definite foreground/background.  The remaining band is refined
+        at full resolution on the crop that contains it.
+
+        The levels are limited so the coarse image and rect keep a
+        minimum size.  If the coarse GrabCut finds no foreground, the
+        initialization falls back to full resolution.
+        """
+        # ---------------------  GrabCut on pyramid level  ------------------
+        levels = self._coarse_levels(img.shape, rect)
+        small = img
+        for _ in range(levels):
+            small = cv2.pyrDown(small)
+        scale = small.shape[1] / float(img.shape[1])
+        rect_small = [max(1, int(v * scale)) for v in rect]
+
+        # GC_FGD (1) and GC_PR_FGD (3) are the odd labels
+        fg_small = None
+        if levels > 0:
+            fg_small = self._coarse_mask(small, rect_small) & 1
+        if fg_small is None or not fg_small.any():
+            self.mask = np.zeros(img.shape[:2], np.uint8)
+            cv2.grabCut(img, self.mask, rect, self.bg_model, self.fg_model,
+                self.iterations, cv2.GC_INIT_WITH_RECT)
+            return
+
+        fg = cv2.resize(fg_small, (img.shape[1], img.shape[0]),
+            interpolation=cv2.INTER_NEAREST)
+        self._refine_band(img, fg)
+
+    def _refine_band(self, img, fg):
+        """GrabCut on a band around the boundary of a 0/1 foreground mask
+
+        The pixels further than `band` from the boundary are fixed to
+        definite foreground/background, the band is refined at full
+        resolution on the crop that contains it.  Sets self.mask.
+        """
+        # -------------------  fix pixels outside the band  -----------------
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
+            (2 * self.band + 1, 2 * self.band + 1))
+        inner = cv2.erode(fg, kernel)
+        outer = cv2.dilate(fg, kernel)
+
+        mask = np.where(fg == 1, cv2.GC_PR_FGD, cv2.GC_PR_BGD).astype(np.uint8)
+        mask[outer == 0] = cv2.GC_BGD
+        mask[inner == 1] = cv2.GC_FGD
+        self.mask = mask
+
+        # ----------------  refine the band at full resolution  -------------
+        ys, xs = np.nonzero(outer - inner)
+        if len(ys) == 0:
+            return
+        y0, y1 = max(0, ys.min() - self.band), ys.max() + self.band + 1
+        x0, x1 = max(0, xs.min() - self.band), xs.max() + self.band + 1
+
+        crop_mask = np.ascontiguousarray(mask[y0:y1, x0:x1])
+        try:
+            cv2.grabCut(np.ascontiguousarray(img[y0:y1, x0:x1]), crop_mask,
+                None, self.bg_model, self.fg_model, self.refine_iterations,
+                cv2.GC_INIT_WITH_MASK)
+        except cv2.error:
+            # no background (or foreground) samples in the crop, keep
+            # the initial mask
+            return
+        mask[y0:y1, x0:x1] = crop_mask
+
+    def _relax_mask(self, rect):
+        """Make the labels of the previous frame probable, except outside rect
+
+        GrabCut never relabels the definite GC_FGD/GC_BGD pixels (i.e.
+        the interior and exterior fixed by _refine_band), which would
+        keep the previous position of a moving object as foreground.
+        Only the background outside rect stays definite, as with the
+        GC_INIT_WITH_RECT initialization.
+        """
+        # GC_BGD (0) -> GC_PR_BGD (2), GC_FGD (1) -> GC_PR_FGD (3)
+        np.bitwise_or(self.mask, 2, out=self.mask)
+        x, y, w, h = rect
+        inside = self.mask[y:y + h, x:x + w].copy()
+        self.mask.fill(cv2.GC_BGD)
+        self.mask[y:y + h, x:x + w] = inside
+
+    def _subtract_background(self, img, timer=None):
+        """Foreground of a static camera frame with the background subtractor
+
+        Returns the 0/1 foreground mask of the frame.
+        """
+        small = img
+        if self.motion_scale != 1:
+            small = cv2.resize(img, None, fx=self.motion_scale,
+                fy=self.motion_scale, interpolation=cv2.INTER_AREA)
+
+        # 255 foreground, 127 shadow, 0 background
+        motion = self.subtractor.apply(small)
+        if timer is not None:
+            timer.lap("subtract", motion)
+
+        # ---------------------  morphological cleanup  ---------------------
+        _, fg = cv2.threshold(motion, 200, 1, cv2.THRESH_BINARY)
+        cleaned = cv2.morphologyEx(fg, cv2.MORPH_OPEN, self.kernel)
+        cleaned = cv2.morphologyEx(cleaned, cv2.MORPH_CLOSE, self.kernel)
+        if timer is not None:
+            timer.lap("cleanup", cleaned)
+
+        # shadows and speckles make the motion mask ambiguous
+        ambiguous = False
+        if self.seed_grabcut is not None:
+            n_motion = cv2.countNonZero(motion)
+            if n_motion > 0:
+                n_sure = cv2.countNonZero(cleaned)
+                ambiguous = 1 - n_sure / float(n_motion) > self.seed_grabcut
+
+        if cleaned.shape != img.shape[:2]:
+            cleaned = cv2.resize(cleaned, (img.shape[1], img.shape[0]),
+                interpolation=cv2.INTER_NEAREST)
+
+        if ambiguous and cv2.countNonZero(cleaned) > 0:
+            self._refine_band(img, cleaned)
+            cleaned = self.mask & 1
+            if timer is not None:
+                timer.lap("grabcut", cleaned)
+        return cleaned
+
+    @staticmethod
+    def _apply_mask(img, mask, workspace=None):
+        """Zero the background pixels of the image"""
+        img_out = get_buffer(workspace, "foreground", img.shape, rotate=True)
+        if img_out is not None:
+            # the masked out pixels keep the previous content of dst
+            img_out.fill(0)
+
+        # much faster than broadcasting a multiply over the channels
+        return cv2.bitwise_and(img, img, mask=mask, dst=img_out)
+
+    def _scene_changed(self, img):
+        """Compare a thumbnail of the frame with the previous one"""
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        thumb = cv2.resize(gray, (64, 48), interpolation=cv2.INTER_AREA)
+        changed = self.thumb is None or \
+            cv2.absdiff(thumb, self.thumb).mean() / 255. > self.scene_change
+        self.thumb = thumb
+        return changed
+
+    def extract_foreground(self, img, rect=None, timer=None, workspace=None):
         """GrabCut version to extract foreground
 
-        GrabCut uses an initial bounding box of the foreground.  An 
+        GrabCut uses an initial bounding box of the foreground.  An
         iterative approach ensues with GMM modeling the foreground
         and background.
+
+        With the "mog2" or "knn" engine, the foreground is the motion
+        mask of the background subtractor and rect is ignored.
+
+        Returns the masked image, or the foreground mask if output is
+        "mask", and None.
+
+        If a timer (StageTimer) is provided, the time of each stage
+        is recorded.  If a workspace (Workspace) is provided, the output
+        is one of its rotating buffers.
         """
-        if self.mask is None:
+        if timer is not None:
+            timer.start()
+
+        if self.subtractor is not None:
+            mask2 = self._subtract_background(img, timer)
+            if self.output == "mask":
+                return mask2, None
+
+            img_out = self._apply_mask(img, mask2, workspace)
+            if timer is not None:
+                timer.lap("apply_mask", img_out)
+            return img_out, None
+
+        # (re)allocate the mask on the first frame or a new frame size
+        init = self.mask is None or self.mask.shape != img.shape[:2]
+        if init:
             self.mask = np.zeros(img.shape[:2], np.uint8)
+            self.fg = np.empty(img.shape[:2], np.uint8)
 
         # initial detection box
         if rect is None:
             width = img.shape[1]
             height = img.shape[0]
             rect = [int(0.25 * width), int(0.25*height), int(0.5*width), int(0.5*height)]
-        
-        cv2.grabCut(img, self.mask, rect, self.bg_model, self.fg_model, 5, cv2.GC_INIT_WITH_RECT)
-        mask2 = np.where((self.mask==2)|(self.mask==0), 0,1).astype('uint8')
 
-        img_out = img * mask2[:,:, np.newaxis]
+        if self.temporal:
+            # the thumbnail is updated on every frame
+            init = self._scene_changed(img) or init
+
+        if self.temporal and not init:
+            # resume from the previous mask and models.  The previous
+            # mask lags a moving object, learning the models from it
+            # would pull the background it uncovered into the foreground
+            self._relax_mask(rect)
+            cv2.grabCut(img, self.mask, None, self.bg_model, self.fg_model,
+                self.update_iterations, _GC_EVAL_FROZEN)
+        elif self.levels > 0:
+            self._grabcut_multires(img, rect)
+        else:
+            cv2.grabCut(img, self.mask, rect, self.bg_model, self.fg_model,
+                self.iterations, cv2.GC_INIT_WITH_RECT)
+        if timer is not None:
+            timer.lap("grabcut", self.mask)
+        # GC_FGD (1) and GC_PR_FGD (3) are the odd labels, in place
+        # of the buffer (the coarse to fine mode replaces self.mask)
+        if self.fg is None or self.fg.shape != self.mask.shape:
+            self.fg = np.empty(self.mask.shape, np.uint8)
+        fg = get_buffer(workspace, "foreground_mask", self.mask.shape,
+            rotate=True)
+        if fg is None:
+            fg = self.fg
+        np.bitwise_and(self.mask, 1, out=fg)
+        if self.output == "mask":
+            if timer is not None:
+                timer.lap("mask", fg)
+            return fg, None
+
+        img_out = self._apply_mask(img, fg, workspace)
+        if timer is not None:
+            timer.lap("apply_mask", img_out)
         return img_out, None
 
 
 if __name__ == "__main__":
-    from py_imagelab.test_with_webcam import test_webcam
-    fc = Foreground()
-    test_webcam(process=fc.extract_foreground, title="GrabCut")
\ No newline at end of file
+    from py_imagelab.util import run_process, get_parser, process_options
+    parser = get_parser()
+    parser.add_argument("--cap", default="",
+        help="Video file (same as --input)")
+    parser.add_argument("--temporal", action="store_true",
+        help="Reuse the previous mask and models between frames")
+    parser.add_argument("--levels", default=0, type=int,
+        help="Coarse to fine GrabCut from this pyramid level")
+    parser.add_argument("--engine", default="grabcut",
+        choices=["grabcut", "mog2", "knn"],
+        help="GrabCut or background subtraction (static camera)")
+    parser.add_argument("--seed_grabcut", default=None, type=float,
+        help="Refine ambiguous motion masks with GrabCut")
+    args = parser.parse_args()
+
+    fc = Foreground(temporal=args.temporal, levels=args.levels,
+        engine=args.engine, seed_grabcut=args.seed_grabcut,
+        output="mask" if args.mask_format else "image")
+
+    options = process_options(args)
+    options["in_file"] = args.input or args.cap
+    run_process(
+        process=fc.extract_foreground,
+        params={},
+        title="GrabCut",
+        mask_format=args.mask_format,
+        **options)
@@ -0,0 +1,149 @@
+"""Compact representations of binary segmentation masks
+
+A 0/1 uint8 mask stored as an image costs a byte per pixel.  Bit
+packing brings it to a bit per pixel, run-length encoding to a few
+integers per row for the smooth masks of foreground extraction.
+
+Usage::
+
+    save_mask("/tmp/mask.npz", mask, fmt="rle")
+    mask = load_mask("/tmp/mask.npz")
+"""
+import numpy as np
+
+MASK_FORMATS = ("packbits", "rle")
+
+
+def pack_mask(mask):
+    """Bit pack a binary mask
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        2D mask, non zero pixels are foreground
+
+    Returns
+    -------
+    packed : np.ndarray
+        uint8 array of ceil(h * w / 8) bytes
+    """
+    return np.packbits(mask.ravel() != 0)
+
+
+def unpack_mask(packed, shape):
+    """Inverse of pack_mask
+
+    Parameters
+    ----------
+    packed : np.ndarray
+        The output of pack_mask
+
+    shape : tuple
+        (height, width) of the mask
+
+    Returns
+    -------
+    mask : np.ndarray
+        0/1 uint8 mask
+    """
+    count = int(np.prod(shape))
+    return np.unpackbits(packed, count=count).reshape(shape)
+
+
+def rle_encode(mask):
+    """Run-length encode a binary mask (row major)
+
+    The runs alternate between background and foreground, starting
+    with background (the first run is 0 if the mask starts with
+    foreground).
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        2D mask, non zero pixels are foreground
+
+    Returns
+    -------
+    runs : np.ndarray
+        uint32 run lengths
+    """
+    flat = mask.ravel() != 0
+    if flat.size == 0:
+        return np.zeros(0, np.uint32)
+
+    # positions where the value changes
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    runs = np.diff(bounds)
+    if flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype(np.uint32)
+
+
+def rle_decode(runs, shape):
+    """Inverse of rle_encode
+
+    Parameters
+    ----------
+    runs : np.ndarray
+        The output of rle_encode
+
+    shape : tuple
+        (height, width) of the mask
+
+    Returns
+    -------
+    mask : np.ndarray
+        0/1 uint8 mask
+    """
+    values = np.arange(len(runs), dtype=np.uint8) & 1
+    mask = np.repeat(values, runs.astype(np.intp))
+    assert mask.size == np.prod(shape), "Runs do not match the mask shape"
+    return mask.reshape(shape)
+
+
+def save_mask(filename, mask, fmt="packbits"):
+    """Save a binary mask in a compact format
+
+    Parameters
+    ----------
+    filename : str
+        The output file, numpy appends ".npz" if missing
+
+    mask : np.ndarray
+        2D mask, non zero pixels are foreground
+
+    fmt : str
+        "packbits" or "rle"
+    """
+    assert fmt in MASK_FORMATS, "Unknown mask format %s" % fmt
+    if fmt == "packbits":
+        data = pack_mask(mask)
+    else:
+        data = rle_encode(mask)
+    np.savez_compressed(filename, fmt=fmt, shape=mask.shape[:2], data=data)
+
+
+def load_mask(filename):
+    """Load a mask saved by save_mask
+
+    Parameters
+    ----------
+    filename : str
+        The .npz file
+
+    Returns
+    -------
+    mask : np.ndarray
+        0/1 uint8 mask
+    """
+    with np.load(filename) as f_in:
+        fmt = str(f_in["fmt"])
+        shape = tuple(f_in["shape"])
+        data = f_in["data"]
+
+    if fmt == "packbits":
+        return unpack_mask(data, shape)
+    elif fmt == "rle":
+        return rle_decode(data, shape)
+    raise IOError("Unknown mask format (%s) in %s" % (fmt, filename))
@@ -1,10 +1,98 @@
 import cv2
 import os
+import queue
+import threading
+import time
+from py_imagelab.profiling import StageTimer, ProfileWriter
+from py_imagelab.workspace import Workspace
+from py_imagelab.video_io import open_writer
+
+
+class _CaptureThread(threading.Thread):
+    """Read (and downsample) frames from a video capture into a queue
+
+    Parameters
+    ----------
+    vc : cv2.VideoCapture
+        The opened video capture
+
+    down : int
+        Number of pyrDown applied to the frames
+
+    queue_size : int
+        Maximum number of frames waiting to be processed
+
+    drop_stale : bool
+        If true, drop the oldest waiting frame when the queue is full
+        instead of blocking the capture (avoids building up lag on live
+        sources).
+
+    max_frames : int or None
+        Stop after reading this many frames
+    """
+    def __init__(self, vc, down=0, queue_size=4, drop_stale=False,
+            max_frames=None):
+        super().__init__(daemon=True)
+        self.vc = vc
+        self.down = down
+        self.max_frames = max_frames
+        self.drop_stale = drop_stale
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.dropped = 0
+
+    def _put(self, frame):
+        if self.drop_stale:
+            while True:
+                try:
+                    self.frames.put_nowait(frame)
+                    return
+                except queue.Full:
+                    try:
+                        self.frames.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        else:
+            while not self.stopped.is_set():
+                try:
+                    self.frames.put(frame, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+    def run(self):
+        n_read = 0
+        while not self.stopped.is_set():
+            if self.max_frames is not None and n_read >= self.max_frames:
+                break
+
+            ret, frame = self.vc.read()
+            if not ret:
+                break
+            n_read += 1
+
+            for _ in range(self.down):
+                frame = cv2.pyrDown(frame)
+            self._put(frame)
+
+        # signal end of stream
+        self._put(None)
+
+    def read(self):
+        """Get the next frame, None at the end of the stream"""
+        return self.frames.get()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
 
 def test_webcam(
         out=None, process=None, params=None, title="Preview",
-        cap=0, down=1):
+        cap=0, down=0, pipeline=False, queue_size=4, drop_stale=None,
+        display=True, start_frame=0, max_frames=None, profile=None,
+        reuse_buffers=False, fourcc=None):
     """Debugging function to apply process to input from webcam
 
     This function can be used to test a processing step on
@@ -15,7 +103,10 @@ def test_webcam(
     Parameters
     ----------
     out : str
-        The output file or None
+        The output video file, image sequence pattern (i.e.
+        "frames/%06d.png") or None.  The output is written on
+        background threads and sized from the first processed frame,
+        see open_writer.
 
     process : func or None
         If none, just display the input from the webcam.
@@ -32,6 +123,60 @@ def test_webcam(
     cap : int or str
         The capture device.  Default to 0 for webcam.
         If string, could be a video file
+
+    down : int
+        Number of pyrDown applied to the frames (as run_process)
+
+    pipeline : bool
+        If true, capture also runs on its own thread connected to the
+        processing loop by a bounded queue, so decode of the next frame
+        overlaps with the process.
+
+    queue_size : int
+        Size of the capture and writer queues.
+
+    drop_stale : bool or None
+        In pipeline mode, drop the oldest queued frame instead of
+        blocking the capture when processing falls behind.  None drops
+        for live devices (int cap) and keeps every frame of video files.
+
+    display : bool
+        Show the processed frames and exit on 'esc'.  If false, no GUI
+        calls are made and the loop only ends at the end of the stream
+        (or max_frames).
+
+    start_frame : int
+        Index of the first frame to process
+
+    max_frames : int or None
+        Maximum number of frames to process
+
+    profile : str, ProfileWriter or None
+        If provided, a StageTimer is passed to the process as "timer"
+        and the stage timings of every frame are written as JSON lines
+        to this file (or writer).
+
+    reuse_buffers : bool
+        If true, a Workspace is passed to the process as "workspace"
+        and kept for the whole stream, so the process writes into the
+        same buffers every frame.  In pipeline mode its outputs rotate
+        over queue_size + 2 buffers, the frames waiting in the writer
+        queue are not overwritten.  The frames are also read into the
+        same buffer outside of pipeline mode without output.
+
+    fourcc : str or None
+        Codec of the output video, None selects it from the extension
+        (see AsyncVideoWriter)
+
+    Returns
+    -------
+    summary : dict
+        "frames" processed, wall "time" in seconds, "fps" and the
+        number of "dropped" stale frames.
+
+    See Also
+    --------
+    process_video : Headless processing of a video file
     """
     # ---------------------  create video capture  object  ------------------
     # video capture object
@@ -43,34 +188,68 @@ def test_webcam(
     if not vc.isOpened():
         raise IOError("Unable to open video capture")
 
+    if start_frame > 0 and not vc.set(cv2.CAP_PROP_POS_FRAMES, start_frame):
+        # not seekable (live device), skip frames instead
+        for _ in range(start_frame):
+            vc.grab()
+
     # ----------------------  prepare output file writer  -------------------
+    writer = None
     if out is not None:
         assert isinstance(out, str),\
             "Expecting the string path of output file"
 
-        # get dimensions of input from the webcam
-        ret, frame = vc.read()
+        # opens with the size of the first processed frame
+        writer = open_writer(out, fps, fourcc, queue_size)
+
+    # ---------------------  prepare stage profiling  ------------------------
+    profiler = profile
+    if isinstance(profile, str):
+        profiler = ProfileWriter(profile)
 
-        for _ in range(1, down):
-            frame = cv2.pyrDown(frame)
+    # -------------------  buffers kept across frames  ----------------------
+    workspace = None
+    if reuse_buffers:
+        # outputs waiting for the writer must not be overwritten
+        workspace = Workspace(writer.queue_size + 2 if writer is not None
+            else 1)
 
-        # prepare output file
-        out_file = cv2.VideoWriter(
-            out,
-            cv2.VideoWriter_fourcc(*'MJPG'),
-            fps,
-            (frame.shape[1], frame.shape[0])
-        )
+    # ---------------------  start pipeline threads  ------------------------
+    capture = None
+    if pipeline:
+        if drop_stale is None:
+            drop_stale = not isinstance(cap, str)
+        capture = _CaptureThread(vc, down, queue_size, drop_stale,
+            max_frames)
+        capture.start()
 
     # tell user how to exit
-    print("Hit the 'esc' key to exit")
+    if display:
+        print("Hit the 'esc' key to exit")
 
-    while True:
+    n_frames = 0
+    raw = None
+    t_start = time.perf_counter()
+    while max_frames is None or n_frames < max_frames:
         # get frame from input video capture device
-        ret, frame = vc.read()
+        if capture is not None:
+            frame = capture.read()
+            if frame is None:
+                # end of stream
+                break
+        else:
+            if workspace is not None and writer is None:
+                # decode into the previous frame
+                ret, raw = vc.read(raw)
+                frame = raw
+            else:
+                ret, frame = vc.read()
+            if not ret:
+                # end of stream
+                break
 
-        for _ in range(1, down):
-            frame = cv2.pyrDown(frame)
+            for _ in range(down):
+                frame = cv2.pyrDown(frame)
         # -----------------------  process the image  -----------------------
         detections = None
         if process is None:
@@ -80,12 +259,24 @@ def test_webcam(
         else:
             if params is None:
                 # no parameters provided
-                processed_frame, detections = process(frame)
+                kwargs = {}
 
             else:
                 assert isinstance(params, dict), "Expecting dict for params"
                 # process params as keyword dict
-                processed_frame, detections = process(frame, **params)
+                kwargs = params
+
+            if profiler is not None:
+                timer = StageTimer()
+                kwargs = dict(kwargs, timer=timer)
+            if workspace is not None:
+                kwargs = dict(kwargs, workspace=workspace)
+                workspace.next()
+
+            processed_frame, detections = process(frame, **kwargs)
+
+            if profiler is not None:
+                profiler.write(timer.records, source=str(cap))
 
         # -----------------------  display frame  ---------------------------
         # update detection boxes into the image
@@ -95,25 +286,104 @@ def test_webcam(
                     (x,y), (x+w, y+h), color=(200,0,0), thickness=10)
 
         # display image
-        cv2.imshow(title, processed_frame)
+        if display:
+            cv2.imshow(title, processed_frame)
+
+        if writer is not None:
+            writer.write(processed_frame)
+        n_frames += 1
 
-        if out is not None:
-            out_file.write(processed_frame)
         # -------------------  exit on 'esc' key  ---------------------------
-        if cv2.waitKey(1) == 27:
+        if display and cv2.waitKey(1) == 27:
             break
 
+    dropped = 0
+    if capture is not None:
+        capture.stop()
+        dropped = capture.dropped
+        if dropped:
+            print("Dropped %d stale frames" % dropped)
+    if writer is not None:
+        writer.close()
+    if isinstance(profile, str):
+        profiler.close()
+    elapsed = time.perf_counter() - t_start
+
     vc.release()
-    cv2.destroyAllWindows()
+    if display:
+        cv2.destroyAllWindows()
+
+    return {
+        "frames": n_frames,
+        "time": elapsed,
+        "fps": n_frames / elapsed if elapsed > 0 else 0.0,
+        "dropped": dropped,
+    }
+
+
+def process_video(in_file, out=None, process=None, params=None, down=0,
+        start_frame=0, max_frames=None, pipeline=False, profile=None,
+        fourcc=None):
+    """Apply a process to a video file without any display
+
+    Runs until the end of the stream (or max_frames), so it can be used
+    in batch jobs on machines without a display.
+
+    Parameters
+    ----------
+    in_file : str
+        The input video file
+
+    out : str or None
+        The output video file or image sequence pattern
+
+    process : func or None
+        The process applied to each frame, see test_webcam
+
+    params : None or Dict
+        Keyword arguments for the process
+
+    down : int
+        Number of pyrDown applied to the frames
+
+    start_frame : int
+        Index of the first frame to process
+
+    max_frames : int or None
+        Maximum number of frames to process
+
+    pipeline : bool
+        Overlap capture with the process on a thread
+
+    profile : str, ProfileWriter or None
+        Write per-frame stage timings as JSON lines, see test_webcam
+
+    fourcc : str or None
+        Codec of the output video, see test_webcam
+
+    Returns
+    -------
+    summary : dict
+        "frames" processed, wall "time" in seconds and "fps"
+    """
+    return test_webcam(out=out, process=process, params=params,
+        cap=in_file, down=down, pipeline=pipeline, drop_stale=False,
+        display=False, start_frame=start_frame, max_frames=max_frames,
+        profile=profile, fourcc=fourcc)
 
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser()
-    parser.add_argument("out", default="", help="Output file")
+    parser.add_argument("out", default="",
+        help="Output video file or image sequence pattern (%%06d.png)")
     parser.add_argument(
         "--cap", default="",
         help="Video file.  If not provided, use webcam as input")
+    parser.add_argument("--pipeline", action="store_true",
+        help="Run capture on a separate thread")
+    parser.add_argument("--fourcc", default=None,
+        help="Codec of the output video (default from the extension)")
     args = parser.parse_args()
 
     assert len(args.out) > 0, "Expecting an output file"
@@ -122,4 +392,5 @@ if __name__ == "__main__":
     else:
         cap = args.cap
 
-    test_webcam(out=args.out, cap=cap)
\ No newline at end of file
+    test_webcam(out=args.out, cap=cap, pipeline=args.pipeline,
+        fourcc=args.fourcc)
\ No newline at end of file
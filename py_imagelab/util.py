@@ -4,8 +4,14 @@ import os
 import mimetypes
 mimetypes.init()
 from argparse import ArgumentParser
+from multiprocessing import Pool
 import cv2
 from py_imagelab.test_with_webcam import test_webcam
+from py_imagelab.profiling import StageTimer, ProfileWriter
+from py_imagelab.workspace import Workspace
+from py_imagelab.cache import ResultCache
+from py_imagelab.loader import load_image, prefetch
+from py_imagelab.segmentation.mask_codec import MASK_FORMATS, save_mask
 
 
 def get_file_type(filepath):
@@ -26,7 +32,10 @@ def get_file_type(filepath):
 
     guess, _ = mimetypes.guess_type(filepath)
 
-    if "video" in guess:
+    if guess is None:
+        return
+
+    elif "video" in guess:
         return "video"
 
     elif "image" in guess:
@@ -51,11 +60,182 @@ def get_parser():
         help="Output image file")
     parser.add_argument("--down", default=1, type=int, help="Downsample image")
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--workers", default=1, type=int,
+        help="Number of worker processes in directory mode (0 = all cores)")
+    parser.add_argument("--pipeline", action="store_true",
+        help="Overlap video capture, process and writing on threads")
+    parser.add_argument("--headless", action="store_true",
+        help="Process video without display until the end of the stream")
+    parser.add_argument("--profile", default="",
+        help="Write per-frame stage timings to this JSONL file")
+    parser.add_argument("--mask_format", default="",
+        choices=("",) + MASK_FORMATS,
+        help="Save the process output as a compact mask (.npz)")
+    parser.add_argument("--fourcc", default=None,
+        help="Codec of video outputs (default from the extension)")
+    parser.add_argument("--cache", default="",
+        help="Result cache directory for image inputs")
+    parser.add_argument("--cache_size", default=1024, type=int,
+        help="Maximum size of the result cache in MB")
+    parser.add_argument("--reuse_buffers", action="store_true",
+        help="Pass a workspace to the process, reused across frames/images")
+    parser.add_argument("--full_decode", action="store_true",
+        help="Decode images at full resolution before downsampling")
     return parser
 
 
+def process_options(args):
+    """Keyword arguments of run_process from the get_parser options
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed arguments of get_parser
+
+    Returns
+    -------
+    options : dict
+        in_file, out_file and the processing options of run_process.
+        mask_format is left out, only processes returning a mask set it.
+    """
+    return {
+        "in_file": args.input,
+        "out_file": args.output,
+        "down": args.down,
+        "overwrite": args.overwrite,
+        "workers": args.workers,
+        "pipeline": args.pipeline,
+        "headless": args.headless,
+        "profile": args.profile,
+        "reuse_buffers": args.reuse_buffers,
+        "fourcc": args.fourcc,
+        "cache": args.cache,
+        # MB on the command line
+        "cache_size": args.cache_size << 20,
+        "reduced": not args.full_decode,
+    }
+
+
+# process and parameters loaded once per pool worker by _init_worker
+_WORKER = {}
+
+
+def _init_worker(process, params):
+    """Initialize a pool worker with the process and its parameters
+
+    Called once per worker process, so detectors/models carried by a
+    bound method are only unpickled (and loaded) once per worker.
+    """
+    # each worker gets a core, avoid oversubscribing with OpenCV threads
+    cv2.setNumThreads(1)
+    _WORKER["process"] = process
+    _WORKER["params"] = params
+
+
+def _process_file(process, params, task, image_rgb=None):
+    """Load, downsample, process and save a single image file
+
+    Parameters
+    ----------
+    process : function
+        Function with the signature used by run_process
+
+    params : dict
+        Keyword arguments passed to process
+
+    task : tuple
+        (in_path, out_path, down, reduced, profile, mask_format).  See
+        load_image for down and reduced.  If profile is true, a
+        StageTimer is passed to the process.  If mask_format is
+        provided, the output is a mask saved with save_mask.
+
+    image_rgb : np.ndarray, Exception or None
+        The image already loaded (i.e. by prefetch), or the error raised
+        while loading it.  None loads in_path.
+
+    Returns
+    -------
+    in_path : str
+        The input file
+
+    error : str or None
+        Description of the failure, None on success
+
+    records : list or None
+        The stage records if profiled
+    """
+    in_path, out_path, down, reduced, profile, mask_format = task
+    timer = None
+    if profile:
+        timer = StageTimer()
+        params = dict(params, timer=timer)
+
+    try:
+        if isinstance(image_rgb, Exception):
+            raise image_rgb
+        if image_rgb is None:
+            image_rgb = load_image(in_path, down, reduced)
+
+        out_image, out_detect = process(image_rgb, **params)
+        if mask_format:
+            save_mask(out_path, out_image, mask_format)
+        elif not cv2.imwrite(out_path, out_image):
+            raise IOError("Unable to write (%s)" % out_path)
+
+    except Exception as err:
+        return in_path, "%s: %s" % (type(err).__name__, err), None
+
+    return in_path, None, timer.records if timer is not None else None
+
+
+def _run_worker(task):
+    """Pool entry point, process one image with the worker's process"""
+    return _process_file(_WORKER["process"], _WORKER["params"], task)
+
+
+def _collect_results(results, profiler=None, done=None):
+    """Print the failed files of _process_file results
+
+    Parameters
+    ----------
+    results : iterable
+        (in_path, error, records) per file
+
+    profiler : ProfileWriter or None
+        Writes the stage records of the files
+
+    done : func or None
+        Called with the input file of each success
+
+    Returns
+    -------
+    n_failed : int
+        The number of failed files
+    """
+    n_failed = 0
+    for c_file, error, records in results:
+        if error is not None:
+            n_failed += 1
+            print("File (%s) failed...%s" % (c_file, error))
+            continue
+
+        if profiler is not None:
+            profiler.write(records, source=c_file)
+        if done is not None:
+            done(c_file)
+    return n_failed
+
+
+def _print_summary(in_file, summary):
+    """Print the summary returned by test_webcam"""
+    print("File (%s) processed %d frames in %.2f s (%.1f fps)" % (
+        in_file, summary["frames"], summary["time"], summary["fps"]))
+
+
 def run_process(process, params, title, in_file, out_file, down=1,
-        overwrite=False):
+        overwrite=False, workers=1, pipeline=False, headless=False,
+        profile="", mask_format="", reuse_buffers=False, fourcc=None,
+        cache="", cache_size=1 << 30, reduced=True):
     """Run process
 
     Parameters
@@ -77,10 +257,61 @@ def run_process(process, params, title, in_file, out_file, down=1,
         The output file or directory
 
     down : int
-        down sample with pyrDown.
+        down sample with pyrDown.  Image inputs are decoded at reduced
+        resolution for up to 3 levels (see load_image).
 
     overwrite : bool
         Allow overwrite if true.
+
+    workers : int
+        Number of worker processes used for the images in directory
+        mode.  0 uses all cores.  The process (and the object it is
+        bound to) is sent to each worker once, so it must be picklable.
+
+    pipeline : bool
+        Run video/webcam input through the threaded capture, process,
+        write pipeline of test_webcam.
+
+    headless : bool
+        Process video/webcam input without display or GUI calls.  Video
+        files end at the end of the stream and a summary is printed.
+
+    profile : str
+        If provided, a StageTimer is passed to the process as "timer"
+        and the stage timings of every image/frame are written to this
+        JSONL file.
+
+    mask_format : str
+        If provided ("packbits" or "rle"), the output of the process is
+        a binary mask saved with save_mask instead of an image, in
+        image and directory mode.  Output files get the ".npz" extension.
+
+    reuse_buffers : bool
+        If true, a Workspace is passed to the process as "workspace" and
+        kept across the frames of a video, or the images of a directory
+        (one per worker process), see test_webcam.
+
+    fourcc : str or None
+        Codec of the video outputs, None selects it from the extension.
+        Video outputs are encoded on a background thread, an output
+        with "%" (i.e. "frames/%06d.png") writes an image sequence.
+
+    cache : str
+        If provided, directory of a ResultCache of the image results,
+        keyed by the content of the input, the process and params.  In
+        image and directory mode, the cached images are restored
+        instead of processed and outputs are replaced when the input or
+        the params changed (overwrite is implied for them).
+
+    cache_size : int
+        Maximum size of the cache in bytes, least recently used results
+        are evicted beyond
+
+    reduced : bool
+        Decode the image inputs at reduced resolution when downsampling.
+        False decodes them at full resolution and runs pyrDown.  In
+        sequential directory mode, the next images are loaded while the
+        current one is processed.
     """
     # -------------------------  check mode  --------------------------------
     if in_file:
@@ -95,34 +326,76 @@ def run_process(process, params, title, in_file, out_file, down=1,
     else:
         mode = "webcam"
 
-    if mode != "dir" and not overwrite:
-        # single file mode...check out_file
+    if mode == "image" and mask_format:
+        # save_mask writes .npz files (as in directory mode)
+        out_file = os.path.splitext(out_file)[0] + ".npz"
+
+    results = ResultCache(cache, cache_size) if cache else None
+    if mode != "dir" and not overwrite and \
+            not (mode == "image" and results is not None):
+        # single file mode...check out_file (cached images are replaced)
         assert not os.path.isfile(out_file), "File already exist...abort"
 
+    # stage timings of all images/frames go to one JSONL file
+    profiler = ProfileWriter(profile) if profile else None
+
+    # video/webcam input get their workspace from test_webcam
+    image_params = params
+    if reuse_buffers:
+        image_params = dict(params, workspace=Workspace())
+
     # ----------------------------  run process  ----------------------------
     if mode == "image":
         # process single file
         # load file and downsample if provided
-        image_rgb = cv2.imread(in_file)
-        for _ in range(down):
-            image_rgb = cv2.pyrDown(image_rgb)
-        out_image, out_detect = process(image_rgb, **params)
+        key = None
+        restored = False
+        if results is not None:
+            key = results.key(in_file, process, params, down=down,
+                mask_format=mask_format, reduced=reduced)
+            restored = results.restore(key, out_file)
+            if restored:
+                print("File (%s) restored from cache" % out_file)
+
+        if not restored:
+            image_rgb = load_image(in_file, down, reduced)
+
+            if profiler is not None:
+                timer = StageTimer()
+                out_image, out_detect = process(image_rgb, timer=timer,
+                    **image_params)
+                profiler.write(timer.records, source=in_file)
+            else:
+                out_image, out_detect = process(image_rgb, **image_params)
+
+            if mask_format:
+                save_mask(out_file, out_image, mask_format)
+            else:
+                if out_detect is not None:
+                    for (x,y,w,h) in out_detect:
+                        thickness = int(1 + np.log10(np.min((w,h))))
+                        out_image = cv2.rectangle(out_image, (x,y),
+                            (x+w, y+h), color=(200,0,0), thickness=thickness)
+                cv2.imwrite(out_file, out_image)
 
-        if out_detect is not None:
-            for (x,y,w,h) in out_detect:
-                thickness = int(1 + np.log10(np.min((w,h))))
-                out_image = cv2.rectangle(out_image,
-                    (x,y), (x+w, y+h), color=(200,0,0), thickness=thickness)
-        cv2.imwrite(out_file, out_image)
+            if key is not None:
+                results.store(key, out_file)
 
     elif mode == "video":
         # process single video file
-        test_webcam(out=out_file,
+        summary = test_webcam(out=out_file,
             process=process,
             params=params,
             title=title,
             cap=in_file,
-            down=down)
+            down=down,
+            pipeline=pipeline,
+            display=not headless,
+            profile=profiler,
+            reuse_buffers=reuse_buffers,
+            fourcc=fourcc)
+        if headless:
+            _print_summary(in_file, summary)
 
     elif mode == "webcam":
         # process on webcam
@@ -130,7 +403,12 @@ def run_process(process, params, title, in_file, out_file, down=1,
             process=process,
             params=params,
             title=title,
-            down=down)
+            down=down,
+            pipeline=pipeline,
+            display=not headless,
+            profile=profiler,
+            reuse_buffers=reuse_buffers,
+            fourcc=fourcc)
 
     elif mode == "dir":
         # process file
@@ -148,29 +426,79 @@ def run_process(process, params, title, in_file, out_file, down=1,
 
         # ------------------------  run process per file  -------------------
         files = os.listdir(in_file)
+        tasks = []
+        keys = {}
         for c_file in files:
             tmp_file = os.path.join(c_dir, c_file)
+            if not os.path.isfile(tmp_file):
+                continue
             c_mode = get_file_type(tmp_file)
 
             # set output file...check if it already exists
             out_file = os.path.join(o_dir, c_file)
-            if os.path.isfile(out_file) and not overwrite:
+            if mask_format and c_mode == "image":
+                out_file = os.path.splitext(out_file)[0] + ".npz"
+            cached = results is not None and c_mode == "image"
+            if os.path.isfile(out_file) and not overwrite and not cached:
                 print("File (%s) exist...skipping" % out_file)
+                continue
 
             # --------------  run process per image/video file  -------------
-            if c_mode == "image":
-                # load file and downsample if provided
-                image_rgb = cv2.imread(tmp_file)
-                for _ in range(down):
-                    image_rgb = cv2.pyrDown(image_rgb)
+            if cached:
+                key = results.key(tmp_file, process, params, down=down,
+                    mask_format=mask_format, reduced=reduced)
+                if results.restore(key, out_file):
+                    continue
+                keys[tmp_file] = (key, out_file)
 
-                out_image, out_detect = process(image_rgb, **params)
-                cv2.imwrite(out_file, out_image)
+            if c_mode == "image":
+                # images are queued and run below (optionally in parallel)
+                tasks.append((tmp_file, out_file, down, reduced,
+                    profiler is not None, mask_format))
 
             elif c_mode == "video":
-                test_webcam(out=out_file,
+                summary = test_webcam(out=out_file,
                     process=process,
                     params=params,
                     title=title,
                     cap=tmp_file,
-                    down=down)
+                    down=down,
+                    pipeline=pipeline,
+                    display=not headless,
+                    profile=profiler,
+                    reuse_buffers=reuse_buffers,
+                    fourcc=fourcc)
+                if headless:
+                    _print_summary(tmp_file, summary)
+
+        # ---------------------  process queued images  ---------------------
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(tasks))
+
+        def done(c_file):
+            # add the new results to the cache
+            if c_file in keys:
+                results.store(*keys[c_file])
+
+        if workers > 1:
+            with Pool(workers, initializer=_init_worker,
+                    initargs=(process, image_params)) as pool:
+                n_failed = _collect_results(
+                    pool.imap_unordered(_run_worker, tasks), profiler, done)
+        else:
+            # load the next images while processing
+            images = prefetch([t[0] for t in tasks], down, reduced)
+            n_failed = _collect_results(
+                (_process_file(process, image_params, t, image)
+                    for t, (_, image) in zip(tasks, images)),
+                profiler, done)
+
+        print("Processed %d images, %d failed" % (len(tasks), n_failed))
+        if results is not None:
+            print("Restored %d images from cache" % results.hits)
+
+    if profiler is not None:
+        profiler.close()
+    if results is not None:
+        results.save()
@@ -0,0 +1,234 @@
+"""Video and image sequence outputs that encode off the processing thread
+
+AsyncVideoWriter hands the frames to a cv2.VideoWriter on a background
+thread through a bounded queue, ImageSequenceWriter encodes numbered
+images on a thread pool (cv2.imwrite releases the GIL).  Both open
+lazily with the size of the first frame written, so the output always
+matches the processed frames.  open_writer picks one from the output
+name::
+
+    writer = open_writer("/tmp/out.mp4", fps=30)        # mp4v
+    writer = open_writer("/tmp/frames/%06d.jpg")        # image sequence
+    for frame in frames:
+        writer.write(frame)
+    writer.close()
+
+The writers hold a reference to the queued frames, the caller must not
+modify a frame after writing it (see Workspace rotation).
+"""
+import cv2
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# default codec of the containers, other codecs depend on the OpenCV build
+DEFAULT_FOURCC = {
+    ".avi": "MJPG",
+    ".mp4": "mp4v",
+    ".m4v": "mp4v",
+    ".mov": "mp4v",
+    ".mkv": "XVID",
+}
+
+
+class AsyncVideoWriter():
+    """cv2.VideoWriter running on a background thread
+
+    Parameters
+    ----------
+    filename : str
+        The output video file, the extension selects the container
+
+    fps : float
+        Frame rate of the output
+
+    fourcc : str or None
+        Four character code of the codec.  None uses DEFAULT_FOURCC of
+        the extension ("MJPG" for unknown extensions).
+
+    queue_size : int
+        Maximum number of frames waiting to be encoded.  write blocks
+        when the queue is full.
+    """
+    def __init__(self, filename, fps=30., fourcc=None, queue_size=4):
+        if fourcc is None:
+            ext = os.path.splitext(filename)[1].lower()
+            fourcc = DEFAULT_FOURCC.get(ext, "MJPG")
+        assert len(fourcc) == 4, "Expecting a four character code"
+        if not fps or fps <= 0:
+            # i.e. live devices that do not report a frame rate
+            fps = 30.
+        self.filename = filename
+        self.fps = fps
+        self.fourcc = fourcc
+        self.queue_size = queue_size
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.frame_size = None
+        self.n_frames = 0
+        self.error = None
+        self._thread = None
+
+    def _open(self, frame):
+        """Open the writer with the size of the first frame"""
+        self.frame_size = (frame.shape[1], frame.shape[0])
+        writer = cv2.VideoWriter(self.filename,
+            cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.frame_size,
+            isColor=frame.ndim == 3)
+        if not writer.isOpened():
+            raise IOError("Unable to open video writer (%s, %s)" % (
+                self.filename, self.fourcc))
+
+        self._thread = threading.Thread(target=self._run, args=(writer,),
+            daemon=True)
+        self._thread.start()
+
+    def _run(self, writer):
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                writer.write(frame)
+        except Exception as err:
+            self.error = err
+            # keep consuming, the error is raised to the caller
+            while self.frames.get() is not None:
+                pass
+        finally:
+            writer.release()
+
+    def write(self, frame):
+        """Queue a frame, blocks if queue_size frames are waiting"""
+        if self.error is not None:
+            raise self.error
+        if self._thread is None:
+            self._open(frame)
+        elif (frame.shape[1], frame.shape[0]) != self.frame_size:
+            # cv2.VideoWriter silently drops the frames of another size
+            raise ValueError("Frame size %s does not match the video %s" % (
+                (frame.shape[1], frame.shape[0]), self.frame_size))
+        self.frames.put(frame)
+        self.n_frames += 1
+
+    def close(self):
+        """Encode the queued frames and close the file"""
+        if self._thread is not None:
+            self.frames.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImageSequenceWriter():
+    """Write the frames as numbered images on a thread pool
+
+    Parameters
+    ----------
+    pattern : str
+        Output file pattern with the frame number, i.e.
+        "/tmp/frames/%06d.png".  The extension selects the encoder.
+
+    start : int
+        Number of the first frame
+
+    workers : int or None
+        Number of encoder threads, None uses all cores
+
+    queue_size : int or None
+        Maximum number of frames being encoded, write blocks on the
+        oldest one beyond.  None uses 2 * workers.
+
+    params : list or None
+        cv2.imwrite parameters, i.e. [cv2.IMWRITE_JPEG_QUALITY, 90]
+    """
+    def __init__(self, pattern, start=0, workers=None, queue_size=None,
+            params=None):
+        assert "%" in pattern, "Expecting a pattern with the frame number"
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.pattern = pattern
+        self.n_frames = start
+        self.params = params or []
+        self.queue_size = queue_size or 2 * workers
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+
+        out_dir = os.path.dirname(pattern)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+    @staticmethod
+    def _encode(filename, frame, params):
+        if not cv2.imwrite(filename, frame, params):
+            raise IOError("Unable to write (%s)" % filename)
+
+    def write(self, frame):
+        """Queue a frame, blocks if queue_size frames are being encoded"""
+        while len(self.pending) >= self.queue_size:
+            # raises the errors of the encoder
+            self.pending.popleft().result()
+
+        filename = self.pattern % self.n_frames
+        self.pending.append(self.pool.submit(self._encode, filename, frame,
+            self.params))
+        self.n_frames += 1
+
+    def close(self):
+        """Wait for the frames being encoded"""
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(out, fps=30., fourcc=None, queue_size=4, workers=None):
+    """Open the writer of an output
+
+    Parameters
+    ----------
+    out : str
+        Video file, image sequence pattern (with "%", i.e.
+        "frames/%06d.png") or directory (ending with a separator, the
+        frames are written as %06d.png)
+
+    fps : float
+        Frame rate of a video
+
+    fourcc : str or None
+        Codec of a video, see AsyncVideoWriter
+
+    queue_size : int
+        Maximum number of frames waiting for the video encoder, or being
+        encoded for an image sequence
+
+    workers : int or None
+        Encoder threads of an image sequence
+
+    Returns
+    -------
+    writer : AsyncVideoWriter or ImageSequenceWriter
+        The writer, with write(frame), close() and queue_size (the
+        number of written frames it may still reference)
+    """
+    if out.endswith(os.sep) or os.path.isdir(out):
+        out = os.path.join(out, "%06d.png")
+    if "%" in out:
+        return ImageSequenceWriter(out, workers=workers,
+            queue_size=queue_size)
+    return AsyncVideoWriter(out, fps, fourcc, queue_size)
@@ -0,0 +1,87 @@
+"""Reusable buffers for the processes
+
+A process allocates its intermediate images on every call.  On video,
+the same shapes come back every frame, so a Workspace passed to the
+process as the ``workspace`` keyword argument keeps the buffers alive
+between calls and the process writes into them through the ``dst=``
+arguments of OpenCV.  Processes only use the workspace when one is
+given::
+
+    workspace = Workspace()
+    for frame in frames:
+        cartoon, _ = cartoonify_process(frame, workspace=workspace)
+        workspace.next()
+
+The scratch buffers are overwritten by the next call.  The buffers
+returned to the caller are requested with ``rotate=True`` and cycle
+through ``depth`` copies, so outputs still queued (i.e. to the writer
+thread of the pipeline mode of test_webcam) are not overwritten before
+they are consumed.
+"""
+import numpy as np
+
+
+class Workspace():
+    """Named buffers kept across process calls
+
+    Parameters
+    ----------
+    depth : int
+        Number of copies of the rotating (output) buffers
+    """
+    def __init__(self, depth=1):
+        assert depth >= 1, "Expecting a depth of at least 1"
+        self.depth = depth
+        self.slot = 0
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8, rotate=False):
+        """Get a buffer, allocated on the first call or a new shape/dtype
+
+        Parameters
+        ----------
+        name : str
+            Name of the buffer, unique within a process
+
+        shape : tuple
+            Shape of the buffer
+
+        dtype : np.dtype
+            Data type of the buffer
+
+        rotate : bool
+            If true, the buffer of the current slot (see next)
+
+        Returns
+        -------
+        buf : np.ndarray
+            Buffer with undefined content
+        """
+        key = (name, self.slot if rotate else 0)
+        shape = tuple(shape)
+        buf = self.buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[key] = buf
+        return buf
+
+    def next(self):
+        """Move the rotating buffers to the next slot, once per frame"""
+        self.slot = (self.slot + 1) % self.depth
+
+    @property
+    def nbytes(self):
+        """Memory held by the buffers"""
+        return sum(b.nbytes for b in self.buffers.values())
+
+
+def get_buffer(workspace, name, shape, dtype=np.uint8, rotate=False):
+    """Buffer of the workspace, or None without workspace
+
+    None as the ``dst`` of an OpenCV function allocates the output, so
+    the processes call the functions the same way with and without a
+    workspace.  See Workspace.get for the parameters.
+    """
+    if workspace is None:
+        return None
+    return workspace.get(name, shape, dtype, rotate)
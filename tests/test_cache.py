@@ -0,0 +1,28 @@
+"""Tests of the result cache keys"""
+import os
+import tempfile
+import numpy as np
+import cv2
+from py_imagelab.cache import ResultCache, process_identity
+from py_imagelab.segmentation.face_detection import FaceDetectCascade
+from py_imagelab.segmentation.face_tracking import FaceTracker
+
+
+def test_key_includes_nested_detector_settings():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, "in.png")
+        cv2.imwrite(in_path, np.zeros((32, 32, 3), np.uint8))
+        cache = ResultCache(os.path.join(tmp_dir, "cache"))
+
+        # trackers differing only in the settings of their detector
+        full = FaceTracker(FaceDetectCascade().detect_face, 3)
+        small = FaceTracker(FaceDetectCascade(5000).detect_face, 3)
+        assert process_identity(full.detect_face) != \
+            process_identity(small.detect_face)
+        assert cache.key(in_path, full.detect_face) != \
+            cache.key(in_path, small.detect_face)
+
+        # same settings, same key
+        same = FaceTracker(FaceDetectCascade().detect_face, 3)
+        assert cache.key(in_path, full.detect_face) == \
+            cache.key(in_path, same.detect_face)
@@ -0,0 +1,62 @@
+"""Tests of the GrabCut foreground extraction"""
+import numpy as np
+import cv2
+from py_imagelab.bench import synthetic_image, synthetic_scene
+from py_imagelab.segmentation.foreground_extraction import Foreground
+
+
+def _iou(mask, truth):
+    return (mask & truth).sum() / float(max(1, (mask | truth).sum()))
+
+
+def test_temporal_follows_moving_object():
+    height, width = 240, 320
+    background = synthetic_image(height, width, seed=1)
+    texture = synthetic_image(height, width, seed=2)[:, ::-1]
+    foreground = Foreground(temporal=True, levels=1, output="mask")
+
+    for i in range(8):
+        # object moving 8 pixels per frame, with its texture
+        truth = np.zeros((height, width), np.uint8)
+        cv2.ellipse(truth, (120 + 8 * i, 120), (30, 40), 0, 0, 360, 1, -1)
+        image = np.where(truth[:, :, np.newaxis] == 1,
+            np.roll(texture, 8 * i, axis=1), background)
+
+        cv2.setRNGSeed(0)
+        mask, _ = foreground.extract_foreground(image)
+        mask, truth = mask.astype(bool), truth.astype(bool)
+
+    # the previous positions must not stay foreground
+    assert _iou(mask, truth) > 0.8
+    assert (mask & ~truth).sum() < 200
+
+
+def test_multires_levels_keep_foreground():
+    image, truth = synthetic_scene(480, 640)
+    ious = []
+    for levels in (2, 3, 6):
+        cv2.setRNGSeed(0)
+        mask, _ = Foreground(levels=levels,
+            output="mask").extract_foreground(image)
+        ious.append(_iou(mask.astype(bool), truth))
+
+    # levels beyond the minimum coarse size are clamped
+    assert min(ious) > 0.9
+    assert ious[0] == ious[1] == ious[2]
+
+
+class _EmptyCoarse(Foreground):
+    """Coarse GrabCut finding no foreground"""
+    def _coarse_mask(self, small, rect_small):
+        return np.zeros(small.shape[:2], np.uint8)
+
+
+def test_multires_falls_back_to_full_resolution():
+    image, truth = synthetic_scene(480, 640)
+    cv2.setRNGSeed(0)
+    full, _ = Foreground(output="mask").extract_foreground(image)
+    cv2.setRNGSeed(0)
+    mask, _ = _EmptyCoarse(levels=2, output="mask").extract_foreground(image)
+
+    assert mask.any()
+    assert np.array_equal(mask, full)
@@ -0,0 +1,35 @@
+"""Tests of the image header parsing"""
+import os
+import shutil
+import tempfile
+import cv2
+from py_imagelab.bench import synthetic_image
+from py_imagelab.loader import read_image_info
+
+
+def _truncated_jpeg(dirname, n_bytes):
+    ok, data = cv2.imencode(".jpg", synthetic_image(48, 64, seed=0))
+    assert ok
+    filename = os.path.join(dirname, "truncated_%d.jpg" % n_bytes)
+    with open(filename, "wb") as f_out:
+        f_out.write(data.tobytes()[:n_bytes])
+    return filename
+
+
+def test_truncated_jpeg():
+    dirname = tempfile.mkdtemp()
+    try:
+        # cut inside the markers before the frame header
+        for n_bytes in (3, 5, 30):
+            try:
+                read_image_info(_truncated_jpeg(dirname, n_bytes))
+            except IOError:
+                pass
+            else:
+                assert False, "no error on a %d bytes JPEG" % n_bytes
+
+        # the header is complete, the size is known without decoding
+        info = read_image_info(_truncated_jpeg(dirname, 1000))
+        assert (info["width"], info["height"]) == (64, 48)
+    finally:
+        shutil.rmtree(dirname)
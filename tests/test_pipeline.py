@@ -0,0 +1,37 @@
+"""Tests of the threaded frame pipelines"""
+import itertools
+import threading
+import time
+from functools import partial
+import numpy as np
+from py_imagelab.pipeline import _frame, apply, run_pipeline
+
+
+def _slow_source(n_frames=50):
+    # a camera like source, blocking for a while on each read
+    for index in range(n_frames):
+        time.sleep(0.05)
+        yield _frame(np.zeros((8, 8, 3), np.uint8), "test", str(index), index)
+
+
+def _failing_process(fail_at=3):
+    calls = itertools.count(1)
+
+    def process(image):
+        if next(calls) == fail_at:
+            raise ValueError("stage failure")
+        return image, None
+    return process
+
+
+def test_stage_error_joins_threads():
+    n_threads = threading.active_count()
+    stages = [partial(apply, process=_failing_process()),
+        partial(apply, process=lambda image: (image, None))]
+    try:
+        run_pipeline(_slow_source(), stages)
+    except ValueError as err:
+        assert str(err) == "stage failure"
+    else:
+        assert False, "the stage error was not raised"
+    assert threading.active_count() == n_threads